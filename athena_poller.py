@@ -0,0 +1,66 @@
+import random
+import time
+
+
+# Adaptive completion polling for Athena queries.
+# Starts at a sub-second interval (partition DDL is usually done by then) and backs off
+# exponentially with jitter up to max_interval, bounded by a total deadline instead of a retry count.
+
+TERMINAL_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+
+# batch_get_query_execution takes at most 50 ids per call
+BATCH_SIZE = 50
+
+
+def next_interval(interval, max_interval, backoff=2.0):
+    return min(max_interval, interval * backoff)
+
+
+# Half fixed, half random, so parallel pollers spread out without ever sleeping ~0
+def jittered(interval):
+    return interval / 2 + random.uniform(0, interval / 2)
+
+
+# One batch_get_query_execution round for any number of query ids
+def get_query_executions(athena_client, query_execution_ids):
+    executions = {}
+    for i in range(0, len(query_execution_ids), BATCH_SIZE):
+        response = athena_client.batch_get_query_execution(QueryExecutionIds=query_execution_ids[i:i + BATCH_SIZE])
+        for execution in response['QueryExecutions']:
+            executions[execution['QueryExecutionId']] = execution
+    return executions
+
+
+# Waits on many query ids at once, until all of them (or with first_completed, any of them) are
+# done. Returns {query_execution_id: QueryExecution}; ids still running when the deadline passes
+# come back with their last seen (non terminal) state.
+def wait_for_queries(athena_client, query_execution_ids, timeout=600, initial_interval=0.25, max_interval=10,
+                     first_completed=False):
+
+    deadline = time.monotonic() + timeout
+    interval = initial_interval
+    pending = list(dict.fromkeys(query_execution_ids))
+    executions = {}
+
+    while pending:
+        time.sleep(max(0, min(jittered(interval), deadline - time.monotonic())))
+
+        executions.update(get_query_executions(athena_client, pending))
+        still_pending = [qid for qid in pending if state_of(executions.get(qid)) not in TERMINAL_STATES]
+
+        if first_completed and len(still_pending) < len(pending):
+            break
+        pending = still_pending
+        if pending and time.monotonic() >= deadline:
+            break
+        interval = next_interval(interval, max_interval)
+
+    return executions
+
+
+def wait_for_query(athena_client, query_execution_id, **kwargs):
+    return wait_for_queries(athena_client, [query_execution_id], **kwargs).get(query_execution_id)
+
+
+def state_of(execution):
+    return (execution or {}).get('Status', {}).get('State')
@@ -0,0 +1,84 @@
+import threading
+
+
+# The one boto3 client factory, used by main.py and (through the layer lambdas/build_layer.py
+# packages) by the three lambdas. boto3 and botocore are only imported when the first session is
+# built, so a Lambda path that never calls AWS skips that import on a cold start.
+
+# Shared botocore tuning: enough pooled connections for the fetch/upload workers,
+# TCP keep-alive on idle connections and client-side adaptive retry throttling.
+BOTO_CONFIG = {
+    'max_pool_connections': 50,
+    'tcp_keepalive': True,
+    'retries': {'max_attempts': 10, 'mode': 'adaptive'}
+}
+
+_lock = threading.Lock()
+_session_kwargs = {}
+_session = None
+_clients = {}
+_resources = {}
+_tables = {}
+
+
+# Sets the credentials / region used for the process-wide session and drops anything already built
+def configure(**session_kwargs):
+    global _session, _session_kwargs
+    with _lock:
+        _session_kwargs = session_kwargs
+        _session = None
+        _clients.clear()
+        _resources.clear()
+        _tables.clear()
+
+
+def boto_config():
+    from botocore.config import Config
+    return Config(**BOTO_CONFIG)
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3.session
+            _session = boto3.session.Session(**_session_kwargs)
+        return _session
+
+
+# Clients are created on first use and then reused; boto3 clients are safe to share between threads
+def get_client(service, region_name=None):
+    key = (service, region_name)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session()
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = session.client(service, region_name=region_name, config=boto_config())
+                _clients[key] = client
+    return client
+
+
+# Resources are not thread safe, so callers sharing one across threads should guard it themselves
+def get_resource(service, region_name=None):
+    key = (service, region_name)
+    resource = _resources.get(key)
+    if resource is None:
+        session = get_session()
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = session.resource(service, region_name=region_name, config=boto_config())
+                _resources[key] = resource
+    return resource
+
+
+# DynamoDB Table resources by table name, with the same caveat as get_resource
+def get_table(table_name, region_name=None):
+    key = (table_name, region_name)
+    table = _tables.get(key)
+    if table is None:
+        table = get_resource('dynamodb', region_name).Table(table_name)
+        _tables[key] = table
+    return table
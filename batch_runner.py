@@ -0,0 +1,140 @@
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+import main
+from checkpoint import CheckpointStore
+from partition_registry import PartitionRegistry
+
+
+# Runs fetch -> upload for every (user, utility, file_type)
+# of an input map like
+#
+#   {
+#       "test@test.com": {
+#           "SCE": ["782002","782001","782003","778134"],
+#           "LADWP": ["787778","787779","776519","776518"]
+#       }
+#   }
+#
+# and then registers all the new user_name partitions in bulk through a PartitionRegistry.
+# API and S3 concurrency are capped separately, so a burst of uploads does not starve
+# the API fetches (or the other way around).
+
+FILE_TYPES = ['bills', 'intervals']
+
+batch_config = {
+    "JOB_WORKERS": 8,
+    "API_CONCURRENCY": 16,
+    "S3_CONCURRENCY": 4,
+    # Partition DDL queries in flight at once
+    "ATHENA_CONCURRENCY": 2
+}
+
+
+def run_job(user_name, utility, meters, file_type, s3_slots, registry, checkpoints=None):
+
+    timings = {'user_name': user_name, 'utility': utility, 'file_type': file_type, 'meters': len(meters)}
+    start = time.perf_counter()
+
+    # Marks are staged per job, so only this job's upload decides whether they are kept
+    job_checkpoints = checkpoints.job() if checkpoints is not None else None
+
+    try:
+        lines = main.iter_api_call(utility, meters, file_type=file_type, checkpoints=job_checkpoints)
+        main.write_stream_to_s3(lines, user_name, file_type, skip_empty=checkpoints is not None, s3_slots=s3_slots)
+
+        if job_checkpoints is not None:
+            job_checkpoints.commit()
+
+        if registry is not None:
+            registry.add(main.config['ATHENA_TABLE'].format(file_type=file_type), user_name)
+        timings['status'] = 'OK'
+    except Exception as e:
+        if job_checkpoints is not None:
+            job_checkpoints.rollback()
+        main.logger.exception(f"Job {user_name}/{utility}/{file_type} failed")
+        timings['status'] = f'FAILED: {e}'
+
+    timings['total_s'] = time.perf_counter() - start
+    return timings
+
+
+def make_registry(athena_concurrency=None):
+    return PartitionRegistry(
+        aws_clients.get_client('athena', region_name='us-east-1'),
+        main.config['ATHENA_DATABASE'],
+        main.config['ATHENA_OUTPUT_LOCATION'],
+        state_path=main.config['PARTITION_STATE_PATH'],
+        timeout=main.config['ATHENA_TIMEOUT'],
+        max_concurrency=athena_concurrency or batch_config['ATHENA_CONCURRENCY']
+    )
+
+
+def run_batch(input_param, file_types=FILE_TYPES, checkpoints=None, **limits):
+
+    limits = dict(batch_config, **limits)
+    main.set_api_concurrency(limits['API_CONCURRENCY'])
+    s3_slots = threading.BoundedSemaphore(limits['S3_CONCURRENCY'])
+
+    # In projection mode the tables resolve user_name partitions themselves
+    registry = make_registry(limits['ATHENA_CONCURRENCY']) if main.config['PARTITION_MODE'] == 'ddl' else None
+
+    jobs = [
+        (user_name, utility, meters, file_type)
+        for user_name, utilities in input_param.items()
+        for utility, meters in utilities.items()
+        for file_type in file_types
+    ]
+
+    with ThreadPoolExecutor(max_workers=limits['JOB_WORKERS']) as executor:
+        futures = [executor.submit(run_job, *job, s3_slots, registry, checkpoints) for job in jobs]
+        results = [future.result() for future in futures]
+
+    if registry is not None:
+        athena_start = time.perf_counter()
+        status = registry.flush()
+        print(f"Partition registration: {status} in {time.perf_counter() - athena_start:.2f}s")
+
+    return results
+
+
+# One-off DDL that switches the file_type tables over to partition projection
+def enable_projection(file_types=FILE_TYPES):
+    registry = make_registry()
+    for file_type in file_types:
+        location_template = f"s3://{main.config['BUCKET_NAME']}/" + main.config['KEY'].format(file_type=file_type, user_name='${user_name}')
+        print(file_type, registry.enable_projection(main.config['ATHENA_TABLE'].format(file_type=file_type), location_template))
+
+
+def print_summary(results):
+
+    header = f"{'user_name':<30} {'utility':<8} {'file_type':<10} {'meters':>6} {'fetch+s3':>9}  status"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['user_name']:<30} {r['utility']:<8} {r['file_type']:<10} {r['meters']:>6} "
+              f"{r['total_s']:>8.2f}s  {r['status']}")
+
+
+if __name__ == "__main__":
+
+    # python batch_runner.py input_param.json [--incremental]
+    # python batch_runner.py --enable-projection
+    if '--enable-projection' in sys.argv:
+        enable_projection()
+        sys.exit(0)
+
+    with open(sys.argv[1]) as f:
+        input_param = json.load(f)
+
+    checkpoints = CheckpointStore(main.config['CHECKPOINT_PATH']) if '--incremental' in sys.argv else None
+
+    batch_start = time.perf_counter()
+    results = run_batch(input_param, checkpoints=checkpoints)
+    print_summary(results)
+    print(f"\n{len(results)} jobs in {time.perf_counter() - batch_start:.2f}s")
+    print(f"UtilityAPI: {main.api_client.stats()}")
@@ -0,0 +1,38 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import boto3.session
+import aws_clients
+
+
+# Micro-benchmark: building a session + S3 client on every call (the old write_file_to_s3)
+# against the cached client from aws_clients. No request is sent, only client construction is timed.
+
+NUMBER = 200
+
+
+def per_call_client():
+    session = boto3.session.Session(aws_access_key_id='x', aws_secret_access_key='y', region_name='us-east-1')
+    return session.client('s3')
+
+
+def cached_client():
+    return aws_clients.get_client('s3')
+
+
+if __name__ == "__main__":
+
+    aws_clients.configure(aws_access_key_id='x', aws_secret_access_key='y', region_name='us-east-1')
+
+    # Built once up front, so the cached figure is the lookup alone
+    cached_client()
+
+    per_call = timeit.timeit(per_call_client, number=NUMBER)
+    cached = timeit.timeit(cached_client, number=NUMBER)
+
+    print(f"per-call session + client : {per_call / NUMBER * 1000:.3f} ms/call")
+    print(f"cached client             : {cached / NUMBER * 1000:.3f} ms/call")
+    print(f"speed-up                  : {per_call / cached:.0f}x")
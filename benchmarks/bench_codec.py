@@ -0,0 +1,81 @@
+import os
+import sys
+import timeit
+
+from boto3.dynamodb.types import TypeDeserializer
+
+
+# Micro-benchmark: decoding config table items the old way (a new TypeDeserializer per item,
+# Decimals everywhere, then sorting schd_day for the first queued slot) against the lambdas'
+# own codec, for a legacy 96 slot schd_day item, a compact item and a config row.
+
+NUMBER = 20000
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('config_table_name', 'c2c_config_table')
+
+import config_table
+
+
+def legacy_item(done=37, slot_count=96):
+    return {
+        'file_type': {'S': 'bills'},
+        'load_date': {'S': '2026-10-01'},
+        'processing_flag': {'S': 'Y'},
+        'schd_day': {'L': [{'M': {
+            'schd_id': {'N': str(i + 1)},
+            'schd_time': {'S': f'{i // 4:02d}:{["15:00", "30:00", "45:00", "59:59"][i % 4]}'},
+            'status': {'S': 's' if i < done else 'q'}
+        }} for i in range(slot_count)]}
+    }
+
+
+COMPACT_ITEM = {
+    'file_type': {'S': 'bills'},
+    'load_date': {'S': '2026-10-01'},
+    'processing_flag': {'S': 'Y'},
+    'frequency': {'S': '15min'},
+    'slot_count': {'N': '96'},
+    'next_slot': {'N': '38'}
+}
+
+CONFIG_ROW = {
+    'file_type': {'S': 'bills'},
+    'load_date': {'S': '2999-12-31'},
+    'config_version': {'N': '3'},
+    'database': {'S': 'sampledb'},
+    'source_table': {'S': 'bills_source'},
+    'target_table': {'S': 'bills_target'},
+    'add_partition': {'S': 'ALTER TABLE {table_name} ADD IF NOT EXISTS PARTITION (load_date={load_date}, hour={hour});'},
+    'insert_sql': {'S': 'INSERT INTO {target_table} SELECT * FROM {source_table} WHERE load_date={load_date} AND hour={hour};'},
+    'glue_export_flag': {'BOOL': True},
+    'glue_job_name': {'S': 'c2c_export'},
+    'glue_mapping': {'L': [{'L': [{'S': 'meter_uid'}, {'S': 'string'}, {'S': 'meter_uid'}, {'S': 'string'}]}]}
+}
+
+
+def generic_decode(item):
+    d = TypeDeserializer()
+    return {k: d.deserialize(value=v) for k, v in item.items()}
+
+
+def generic_next_slot(item):
+    schd_day = generic_decode(item)['schd_day']
+    return sorted(schd_day, key=lambda slot: slot['schd_id'] if slot['status'] == 'q' else 999999)[0]['schd_id']
+
+
+def report(name, generic, codec):
+    generic_s = timeit.timeit(generic, number=NUMBER)
+    codec_s = timeit.timeit(codec, number=NUMBER)
+    print(f"{name:<28} generic {generic_s / NUMBER * 1e6:>8.2f} us   codec {codec_s / NUMBER * 1e6:>8.2f} us   "
+          f"{generic_s / codec_s:>5.1f}x")
+
+
+if __name__ == "__main__":
+
+    legacy = legacy_item()
+
+    assert generic_next_slot(legacy) == config_table.decode_schedule_item(legacy).next_slot
+
+    report('legacy schd_day, next slot', lambda: generic_next_slot(legacy), lambda: config_table.decode_schedule_item(legacy))
+    report('compact schedule item', lambda: generic_decode(COMPACT_ITEM), lambda: config_table.decode_schedule_item(COMPACT_ITEM))
+    report('config row', lambda: generic_decode(CONFIG_ROW), lambda: config_table.from_dynamodb_to_json(CONFIG_ROW))
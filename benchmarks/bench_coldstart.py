@@ -0,0 +1,82 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+# Cold-start benchmark of the three lambdas: every run is a fresh interpreter, as on a new
+# Lambda container. Reports the module import time, the first handler call on the path that
+# needs no AWS at all (p2 query_flag 'N', p3 trigger_glue_job_flag 'N'), whether boto3 got
+# imported along the way, and the slowest imports as seen by `python -X importtime`.
+#
+#   python benchmarks/bench_coldstart.py [runs]
+
+LAMBDAS = {
+    'p1': ('lmd_iib_c2c_pipeline_start_p1', None),
+    'p2': ('lmd_iib_c2c_athena_query_runner_p2', {'responsePayload': {'body': {
+        'file_type': 'bills', 'load_date': '2026-10-01', 'hour': '00', 'query_flag': 'N'}}}),
+    'p3': ('lmd_iib_c2c_glue_job_runner_p3', {'responsePayload': {'body': {
+        'file_type': 'bills', 'load_date': '2026-10-01', 'hour': '00', 'trigger_glue_job_flag': 'N'}}}),
+}
+
+PROBE = """
+import contextlib, io, json, sys, time
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+event = json.loads(sys.argv[1])
+if event:
+    with contextlib.redirect_stdout(io.StringIO()):
+        lambda_function.lambda_handler(event, None)
+handled = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'handler_ms': (handled - imported) * 1000,
+                  'boto3_loaded': 'boto3' in sys.modules}))
+"""
+
+# The layer's modules (lambdas/build_layer.py) come from the repo root, as from /opt/python on Lambda
+ENV = dict(os.environ, config_table_name='c2c_config_table', AWS_DEFAULT_REGION='us-east-1', PYTHONPATH=ROOT)
+
+
+def lambda_dir(name):
+    return os.path.join(ROOT, 'lambdas', LAMBDAS[name][0])
+
+
+def probe(name):
+    event = LAMBDAS[name][1]
+    output = subprocess.run([sys.executable, '-c', PROBE, json.dumps(event)], cwd=lambda_dir(name),
+                            env=ENV, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# (cumulative us, module) of the slowest imports under lambda_function
+def slowest_imports(name, top=5):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lambda_function'], cwd=lambda_dir(name),
+                            env=ENV, capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    for name in LAMBDAS:
+        results = [probe(name) for _ in range(runs)]
+        import_ms = statistics.median(r['import_ms'] for r in results)
+        handler_ms = statistics.median(r['handler_ms'] for r in results)
+
+        print(f"\n== {name} ({LAMBDAS[name][0]}), median of {runs} cold starts")
+        print(f"  import                 {import_ms:>8.2f} ms")
+        if LAMBDAS[name][1]:
+            print(f"  fast-path handler      {handler_ms:>8.2f} ms")
+            print(f"  boto3 imported         {'yes' if any(r['boto3_loaded'] for r in results) else 'no'}")
+        for cumulative, module in slowest_imports(name):
+            print(f"  {module:<22} {cumulative / 1000:>8.2f} ms cumulative")
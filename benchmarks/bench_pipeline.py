@@ -0,0 +1,338 @@
+import argparse
+import datetime
+import importlib.util
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import fakes
+
+
+# End-to-end benchmark of p1 -> p2 -> p3 and of main.py's fetch -> upload, all in-process against
+# the fakes in fakes.py, so nothing touches AWS or UtilityAPI.
+#
+#   python benchmarks/bench_pipeline.py                      # every scenario
+#   python benchmarks/bench_pipeline.py backlog_7d --catchup 8 --athena-duration 0.02
+#   python benchmarks/bench_pipeline.py meters_500 --api-latency 0.01 --api-failure-rate 0.02
+#   python benchmarks/bench_pipeline.py normal_day --glue-batch-size 4
+#
+# Athena queries and Glue runs take --athena-duration / --glue-duration secs of wall time (a
+# compressed clock), and the lambdas' poll intervals are scaled down to match. Peak memory is the
+# tracemalloc peak of the scenario, which also slows Python down a little, so compare runs taken
+# with the same flags only.
+
+CONFIG_TABLE = 'c2c_config_table'
+LAMBDAS = {
+    'p1': 'lmd_iib_c2c_pipeline_start_p1',
+    'p2': 'lmd_iib_c2c_athena_query_runner_p2',
+    'p3': 'lmd_iib_c2c_glue_job_runner_p3',
+}
+FILE_TYPES = {'bills': '15min', 'intervals': 'Hourly'}
+START_DATE = datetime.date(2026, 10, 1)
+
+
+def load_lambda(name, env):
+    os.environ.update(env)
+    path = os.path.join(ROOT, 'lambdas', LAMBDAS[name], 'lambda_function.py')
+    spec = importlib.util.spec_from_file_location(f'bench_{name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def file_type_config(file_type):
+    return {
+        'file_type': file_type,
+        'load_date': '2999-12-31',
+        'config_version': 1,
+        'database': 'sampledb',
+        'source_table': f'{file_type}_source',
+        'target_table': f'{file_type}_target',
+        'add_partition': "ALTER TABLE {table_name} ADD IF NOT EXISTS PARTITION (load_date={load_date}, hour={hour});",
+        'insert_sql': "INSERT INTO {target_table} SELECT * FROM {source_table} WHERE load_date={load_date} AND hour={hour};",
+        'insert_range_sql': "INSERT INTO {target_table} SELECT * FROM {source_table} "
+                            "WHERE load_date={load_date} AND hour BETWEEN {hour_start} AND {hour_end};",
+        'glue_export_flag': True,
+        'glue_job_name': 'c2c_export',
+        'athena_source_db': 'sampledb',
+        'athena_source_table': f'{file_type}_target',
+        'rds_target_db': 'c2c',
+        'rds_target_table': file_type,
+        'glue_mapping': [['meter_uid', 'string', 'meter_uid', 'string']],
+        'frequency': FILE_TYPES[file_type]
+    }
+
+
+# Takes the EMF metric lines of the lambdas (and main.py) and counts them
+class MetricSink:
+
+    def __init__(self):
+        self.lines = 0
+
+    def write(self, text):
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+class Pipeline:
+
+    def __init__(self, args):
+        self.table = fakes.FakeTable(CONFIG_TABLE, fakes.Faults(args.aws_latency, args.aws_failure_rate, seed=1))
+        self.dynamodb = fakes.FakeDynamoClient([self.table])
+        self.athena = fakes.FakeAthena(args.athena_duration, args.athena_failure_rate, fakes.Faults(args.aws_latency), seed=2)
+        self.glue = fakes.FakeGlue(args.glue_duration, args.glue_failure_rate, fakes.Faults(args.aws_latency), seed=3)
+
+        env = {
+            'config_table_name': CONFIG_TABLE,
+            'max_catchup_slots': str(args.catchup),
+            'execution_mode': 'blocking',
+            'glue_completion_mode': 'blocking',
+            'glue_batch_size': str(args.glue_batch_size)
+        }
+        self.p1, self.p2, self.p3 = (load_lambda(name, env) for name in ('p1', 'p2', 'p3'))
+
+        # The lambdas' layer modules, shared by all three here (on Lambda each has its own copy)
+        import aws_clients
+        import config_table
+        import metrics
+        aws_clients._clients.update({('dynamodb', None): self.dynamodb, ('athena', None): self.athena,
+                                     ('glue', None): self.glue})
+        aws_clients._tables[(CONFIG_TABLE, None)] = self.table
+        config_table._config_cache.clear()
+
+        poll = min(args.athena_duration, args.glue_duration) / 4 or 0.001
+        self.p2.INITIAL_POLL_INTERVAL, self.p2.MAX_POLL_INTERVAL = poll, poll * 8
+        self.p3.INITIAL_POLL_INTERVAL, self.p3.MAX_POLL_INTERVAL = poll, poll * 8
+
+        for file_type in FILE_TYPES:
+            self.table.put_item(Item=file_type_config(file_type))
+
+        self.timings = {'p1': 0.0, 'p2': 0.0, 'p3': 0.0}
+        self.invocations = 0
+        self.slots = 0
+        self.errors = 0
+        self.metric_sink = MetricSink()
+        metrics.configure(stream=self.metric_sink)
+
+    def timed(self, stage, handler, event):
+        start = time.perf_counter()
+        try:
+            return handler(event, None)
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+    # p1 alone, as the EventBridge rule of a file_type triggers it
+    def schedule(self, file_type, event_datetime):
+        return self.timed('p1', self.p1.lambda_handler, {
+            'file_type': file_type,
+            'schd_start_datetime': f'{START_DATE.isoformat()}T00:00:00Z',
+            'event_datetime': event_datetime.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'frequency': FILE_TYPES[file_type]
+        })
+
+    # One EventBridge tick for a file_type: p1, then p2 and p3 the way the Lambda destinations chain them
+    def tick(self, file_type, event_datetime):
+
+        self.invocations += 1
+        p1_response = self.schedule(file_type, event_datetime)
+        body = p1_response['body']
+        if body['query_flag'] != 'Y':
+            return False
+
+        try:
+            p2_response = self.timed('p2', self.p2.lambda_handler, {'responsePayload': p1_response})
+            self.timed('p3', self.p3.lambda_handler, {'responsePayload': p2_response})
+        except Exception as e:
+            # The slot stays queued and is picked up again on the next tick
+            self.errors += 1
+            print(f"  {file_type} {body['load_date']} {body['hour']}: {e}")
+            return True
+
+        self.slots += body['catchup_slots']
+        return True
+
+    # One tick of p1's fan-out mode: every file_type scheduled by a single p1 invocation
+    def fan_out_tick(self, event_datetime):
+
+        self.invocations += 1
+        p1_response = self.timed('p1', self.p1.lambda_handler, {
+            'fan_out': True,
+            'schd_start_datetime': f'{START_DATE.isoformat()}T00:00:00Z',
+            'event_datetime': event_datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
+        })
+        due = p1_response['body']['slots']
+        if not due:
+            return False
+
+        try:
+            p2_response = self.timed('p2', self.p2.lambda_handler, {'responsePayload': p1_response})
+            self.timed('p3', self.p3.lambda_handler, {'responsePayload': p2_response})
+        except Exception as e:
+            self.errors += 1
+            print(f"  fan-out {event_datetime}: {e}")
+            return True
+
+        self.slots += sum(body['catchup_slots'] for body in due)
+        return True
+
+
+def run_normal_day(args):
+
+    pipeline = Pipeline(args)
+    tick = datetime.datetime.combine(START_DATE, datetime.time(0, 1))
+    for _ in range(96):
+        tick += datetime.timedelta(minutes=15)
+        for file_type in FILE_TYPES:
+            pipeline.tick(file_type, tick)
+    return pipeline_report(pipeline)
+
+
+# The normal day with one p1 fan-out trigger instead of one trigger per file_type
+def run_fan_out_day(args):
+
+    pipeline = Pipeline(args)
+    tick = datetime.datetime.combine(START_DATE, datetime.time(0, 1))
+    for _ in range(96):
+        tick += datetime.timedelta(minutes=15)
+        pipeline.fan_out_tick(tick)
+    return pipeline_report(pipeline)
+
+
+# Seven days of slots overdue at once; ticks repeat until p1 has nothing due any more
+def run_backlog_7d(args):
+
+    pipeline = Pipeline(args)
+    now = datetime.datetime.combine(START_DATE + datetime.timedelta(days=7), datetime.time(0, 5))
+    for file_type in FILE_TYPES:
+        for _ in range(7 * 96 + 1):
+            if not pipeline.tick(file_type, now):
+                break
+    return pipeline_report(pipeline)
+
+
+def pipeline_report(pipeline):
+    return {
+        'stages': pipeline.timings,
+        'invocations': pipeline.invocations,
+        'slots': pipeline.slots,
+        'errors': pipeline.errors,
+        'aws_calls': pipeline.table.faults.total_calls() + pipeline.athena.faults.total_calls() + pipeline.glue.faults.total_calls(),
+        'athena_queries': len(pipeline.athena.runs),
+        'glue_runs': len(pipeline.glue.runs),
+        'metric_lines': pipeline.metric_sink.lines
+    }
+
+
+# main.py's fetch -> upload for one user with `meters` meters, then its partition DDL
+def run_meters(args, meters=500):
+
+    api = fakes.FakeUtilityApi(args.records, args.readings, fakes.Faults(args.api_latency, args.api_failure_rate, error_code=args.api_error, seed=4)).start()
+    s3 = fakes.FakeS3(fakes.Faults(args.aws_latency))
+    athena = fakes.FakeAthena(args.athena_duration, faults=fakes.Faults(args.aws_latency))
+
+    try:
+        import aws_clients
+        import main
+        import metrics
+        from utility_api import TokenBucket
+
+        metric_sink = MetricSink()
+        metrics.configure(stream=metric_sink)
+
+        aws_clients._clients[('s3', None)] = s3
+        aws_clients._clients[('athena', 'us-east-1')] = athena
+        main.api_client.BASE_URL = api.base_url
+        main.api_client.bucket = TokenBucket(args.api_rate)
+        main.set_api_concurrency(args.api_concurrency)
+
+        timings = {}
+        meter_ids = fakes.meter_ids(meters)
+        for file_type in ('bills', 'intervals'):
+            start = time.perf_counter()
+            lines = main.iter_api_call('SCE', meter_ids, file_type=file_type, max_workers=args.api_concurrency)
+            main.write_stream_to_s3(lines, 'bench@test.com', file_type)
+            timings[f'fetch+s3 {file_type}'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        main.athena_query_runner('sampledb', 'bills_table', 'bench@test.com')
+        timings['athena'] = time.perf_counter() - start
+    finally:
+        api.stop()
+
+    fetch_seconds = sum(seconds for stage, seconds in timings.items() if stage.startswith('fetch'))
+    return {
+        'stages': timings,
+        'api_calls': api.faults.total_calls(),
+        'api_calls_per_s': api.faults.total_calls() / fetch_seconds if fetch_seconds else 0,
+        'client_stats': main.api_client.stats(),
+        's3_bytes': s3.bytes_written,
+        'metric_lines': metric_sink.lines
+    }
+
+
+SCENARIOS = {
+    'normal_day': run_normal_day,
+    'fan_out_day': run_fan_out_day,
+    'backlog_7d': run_backlog_7d,
+    'meters_500': run_meters,
+}
+
+
+def print_report(name, report, seconds, peak):
+
+    print(f"\n== {name}: {seconds:.2f}s, peak memory {peak / 1024 / 1024:.1f} MiB")
+    for stage, stage_seconds in report.pop('stages').items():
+        print(f"  {stage:<22} {stage_seconds:>8.3f}s")
+    if 'slots' in report:
+        print(f"  {'slots/min':<22} {report['slots'] / seconds * 60:>8.1f}")
+    for key, value in report.items():
+        print(f"  {key:<22} {value:>8.1f}" if isinstance(value, float) else f"  {key:<22} {value}")
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--catchup', type=int, default=1, help='max_catchup_slots of p1')
+    parser.add_argument('--aws-latency', type=float, default=0.002, help='secs added to every AWS call')
+    parser.add_argument('--aws-failure-rate', type=float, default=0, help='share of DynamoDB calls throttled')
+    parser.add_argument('--athena-duration', type=float, default=0.01)
+    parser.add_argument('--athena-failure-rate', type=float, default=0)
+    parser.add_argument('--glue-duration', type=float, default=0.02)
+    parser.add_argument('--glue-failure-rate', type=float, default=0)
+    parser.add_argument('--glue-batch-size', type=int, default=1, help='glue_batch_size of p3')
+    parser.add_argument('--api-latency', type=float, default=0.005, help='secs the fake UtilityAPI takes per request')
+    parser.add_argument('--api-failure-rate', type=float, default=0)
+    parser.add_argument('--api-error', type=int, default=503, help='HTTP status of injected UtilityAPI failures')
+    parser.add_argument('--api-rate', type=float, default=1000, help='UtilityAPI client rate limit, requests/s')
+    parser.add_argument('--api-concurrency', type=int, default=16)
+    parser.add_argument('--records', type=int, default=12, help='records per meter')
+    parser.add_argument('--readings', type=int, default=96, help='readings per intervals record')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    for name in args.scenarios:
+        tracemalloc.start()
+        start = time.perf_counter()
+        report = SCENARIOS[name](args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print_report(name, report, seconds, peak)
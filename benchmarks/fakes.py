@@ -0,0 +1,566 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+
+# In-process stand-ins for DynamoDB, S3, Athena, Glue and UtilityAPI, just enough of each API for
+# main.py and the three lambdas. Every call goes through a Faults object first, which adds latency,
+# injects errors and counts / times the calls per operation.
+
+
+class Faults:
+
+    # latency: seconds added to every call, or a (min, max) range
+    # failure_rate: share of calls failing with error_code (a ClientError, or an HTTP status for UtilityAPI)
+    def __init__(self, latency=0, failure_rate=0, error_code='ThrottlingException', seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.error_code = error_code
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.seconds = {}
+
+    def delay(self):
+        if isinstance(self.latency, tuple):
+            return self.random.uniform(*self.latency)
+        return self.latency
+
+    def should_fail(self):
+        with self.lock:
+            return self.failure_rate and self.random.random() < self.failure_rate
+
+    def record(self, operation, seconds):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.seconds[operation] = self.seconds.get(operation, 0) + seconds
+
+    def hit(self, operation):
+        start = time.perf_counter()
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+        failed = self.should_fail()
+        self.record(operation, time.perf_counter() - start)
+        if failed:
+            raise ClientError({'Error': {'Code': self.error_code, 'Message': 'Injected failure'}}, operation)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+# --- DynamoDB expressions ---------------------------------------------------------------------
+
+# Covers what the lambdas use: comparisons, and / or / not, attribute_exists, attribute_not_exists,
+# begins_with, size in conditions; SET (with +, -, if_not_exists, list_append) and REMOVE in updates.
+
+TOKEN = re.compile(r'\s*(:\w+|#\w+|[A-Za-z_][\w.]*|<>|<=|>=|=|<|>|\(|\)|,|\+|-)')
+MISSING = object()
+
+
+def tokenize(expression):
+    tokens, position = [], 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise ValueError(f"Cannot parse {expression!r} at {position}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class Expression:
+
+    def __init__(self, expression, values=None, names=None):
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.values = values or {}
+        self.names = names or {}
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and (token or '').lower() != expected:
+            raise ValueError(f"Expected {expected!r}, got {token!r}")
+        self.position += 1
+        return token
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    # operand := :value | path | size(path) | if_not_exists(path, operand) | list_append(operand, operand)
+    def operand(self, item):
+        token = self.take()
+        if token.startswith(':'):
+            return self.values[token]
+        function = token.lower()
+        if self.peek() == '(' and function in ('size', 'if_not_exists', 'list_append'):
+            self.take('(')
+            if function == 'size':
+                value = item.get(self.name(self.take()), MISSING)
+                self.take(')')
+                return MISSING if value is MISSING else len(value)
+            path = self.tokens[self.position]
+            first = self.operand(item)
+            self.take(',')
+            second = self.operand(item)
+            self.take(')')
+            if function == 'if_not_exists':
+                return second if item.get(self.name(path), MISSING) is MISSING else first
+            return list(first) + list(second)
+        return item.get(self.name(token), MISSING)
+
+    def arithmetic(self, item):
+        value = self.operand(item)
+        while self.peek() in ('+', '-'):
+            sign = self.take()
+            other = self.operand(item)
+            value = value + other if sign == '+' else value - other
+        return value
+
+    def condition(self, item):
+        result = self.conjunction(item)
+        while (self.peek() or '').lower() == 'or':
+            self.take()
+            other = self.conjunction(item)
+            result = result or other
+        return result
+
+    def conjunction(self, item):
+        result = self.unary(item)
+        while (self.peek() or '').lower() == 'and':
+            self.take()
+            other = self.unary(item)
+            result = result and other
+        return result
+
+    def unary(self, item):
+        token = (self.peek() or '').lower()
+        if token == 'not':
+            self.take()
+            return not self.unary(item)
+        if token == '(':
+            self.take()
+            result = self.condition(item)
+            self.take(')')
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists', 'begins_with'):
+            self.take()
+            self.take('(')
+            value = item.get(self.name(self.take()), MISSING)
+            if token == 'begins_with':
+                self.take(',')
+                prefix = self.operand(item)
+                self.take(')')
+                return value is not MISSING and str(value).startswith(prefix)
+            self.take(')')
+            return (value is not MISSING) == (token == 'attribute_exists')
+
+        left = self.operand(item)
+        operator = self.take()
+        right = self.operand(item)
+        if left is MISSING or right is MISSING:
+            return operator == '<>'
+        return {
+            '=': lambda: left == right,
+            '<>': lambda: left != right,
+            '<': lambda: left < right,
+            '<=': lambda: left <= right,
+            '>': lambda: left > right,
+            '>=': lambda: left >= right,
+        }[operator]()
+
+
+def evaluate_condition(expression, item, values=None, names=None):
+    if not expression:
+        return True
+    return Expression(expression, values, names).condition(item)
+
+
+def apply_update(expression, item, values=None, names=None):
+
+    parser = Expression(expression, values, names)
+    updated = dict(item)
+    action = None
+
+    while parser.peek() is not None:
+        token = parser.peek()
+        if token.upper() in ('SET', 'REMOVE'):
+            action = parser.take().upper()
+            continue
+        if token == ',':
+            parser.take()
+            continue
+        name = parser.name(parser.take())
+        if action == 'SET':
+            parser.take('=')
+            # Right-hand sides see the item as it was before the update
+            updated[name] = parser.arithmetic(item)
+        elif action == 'REMOVE':
+            updated.pop(name, None)
+        else:
+            raise ValueError(f"Unsupported update expression {expression!r}")
+
+    return updated
+
+
+def conditional_check_failed(operation):
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}, operation)
+
+
+# --- DynamoDB ---------------------------------------------------------------------------------
+
+# One table with a file_type hash key and a load_date range key, items kept as plain Python values.
+# Offers the Table resource calls; FakeDynamoClient wraps it for the low-level calls.
+class FakeTable:
+
+    def __init__(self, name='config_table', faults=None, hash_key='file_type', range_key='load_date'):
+        self.name = name
+        self.faults = faults or Faults()
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def key_of(self, key):
+        return key[self.hash_key], key[self.range_key]
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, ExpressionAttributeNames=None):
+        self.faults.hit('PutItem')
+        with self.lock:
+            key = self.key_of(Item)
+            if not evaluate_condition(ConditionExpression, self.items.get(key, {}), ExpressionAttributeValues, ExpressionAttributeNames):
+                raise conditional_check_failed('PutItem')
+            self.items[key] = dict(Item)
+        return {}
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None, ExpressionAttributeNames=None):
+        self.faults.hit('GetItem')
+        with self.lock:
+            item = self.items.get(self.key_of(Key))
+        if item is None:
+            return {}
+        return {'Item': self.project(item, ProjectionExpression, ExpressionAttributeNames)}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ReturnValues='NONE'):
+        self.faults.hit('UpdateItem')
+        with self.lock:
+            key = self.key_of(Key)
+            old = self.items.get(key) or dict(Key)
+            if not evaluate_condition(ConditionExpression, self.items.get(key, {}), ExpressionAttributeValues, ExpressionAttributeNames):
+                raise conditional_check_failed('UpdateItem')
+            new = apply_update(UpdateExpression, old, ExpressionAttributeValues, ExpressionAttributeNames)
+            self.items[key] = new
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': dict(new)}
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': dict(old)}
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ReturnValues='NONE'):
+        self.faults.hit('DeleteItem')
+        with self.lock:
+            key = self.key_of(Key)
+            if not evaluate_condition(ConditionExpression, self.items.get(key, {}), ExpressionAttributeValues, ExpressionAttributeNames):
+                raise conditional_check_failed('DeleteItem')
+            old = self.items.pop(key, None)
+        if ReturnValues == 'ALL_OLD' and old is not None:
+            return {'Attributes': old}
+        return {}
+
+    # KeyConditionExpression is evaluated as a plain condition over the items of the table
+    def query(self, KeyConditionExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+              ScanIndexForward=True, Limit=None, ProjectionExpression=None, FilterExpression=None, **kwargs):
+        self.faults.hit('Query')
+        with self.lock:
+            items = [item for item in self.items.values()
+                     if evaluate_condition(KeyConditionExpression, item, ExpressionAttributeValues, ExpressionAttributeNames)]
+        items.sort(key=lambda item: (item[self.hash_key], item[self.range_key]), reverse=not ScanIndexForward)
+        if Limit:
+            items = items[:Limit]
+        if FilterExpression:
+            items = [item for item in items if evaluate_condition(FilterExpression, item, ExpressionAttributeValues, ExpressionAttributeNames)]
+        return {'Items': [self.project(item, ProjectionExpression, ExpressionAttributeNames) for item in items], 'Count': len(items)}
+
+    def batch_get(self, keys):
+        self.faults.hit('BatchGetItem')
+        with self.lock:
+            return [dict(self.items[self.key_of(key)]) for key in keys if self.key_of(key) in self.items]
+
+    @staticmethod
+    def project(item, projection, names=None):
+        if not projection:
+            return dict(item)
+        attributes = [(names or {}).get(a.strip(), a.strip()) for a in projection.split(',')]
+        return {a: item[a] for a in attributes if a in item}
+
+
+# Low-level client calls on top of FakeTables, with the values in the typed {'S': ...} form
+class FakeDynamoClient:
+
+    def __init__(self, tables):
+        self.tables = {table.name: table for table in tables}
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def to_python(self, typed):
+        return {k: self.deserializer.deserialize(v) for k, v in (typed or {}).items()}
+
+    def to_typed(self, item):
+        return {k: self.serializer.serialize(v) for k, v in item.items()}
+
+    def query(self, TableName, ExpressionAttributeValues=None, **kwargs):
+        response = self.tables[TableName].query(ExpressionAttributeValues=self.to_python(ExpressionAttributeValues), **kwargs)
+        return dict(response, Items=[self.to_typed(item) for item in response['Items']])
+
+    def get_item(self, TableName, Key, **kwargs):
+        response = self.tables[TableName].get_item(Key=self.to_python(Key), **kwargs)
+        return {'Item': self.to_typed(response['Item'])} if 'Item' in response else {}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            items = self.tables[table_name].batch_get([self.to_python(key) for key in request['Keys']])
+            projection = request.get('ProjectionExpression')
+            names = request.get('ExpressionAttributeNames')
+            responses[table_name] = [self.to_typed(FakeTable.project(item, projection, names)) for item in items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+# --- S3 ---------------------------------------------------------------------------------------
+
+# Keeps object sizes only, so the peak memory measured is the code's and not the fake's
+class FakeS3:
+
+    def __init__(self, faults=None):
+        self.faults = faults or Faults()
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.bytes_written = 0
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.faults.hit('PutObject')
+        with self.lock:
+            self.objects[(Bucket, Key)] = len(Body)
+            self.bytes_written += len(Body)
+        return {'ETag': uuid.uuid4().hex}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.faults.hit('CreateMultipartUpload')
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id, 'Bucket': Bucket, 'Key': Key}
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId, **kwargs):
+        self.faults.hit('UploadPart')
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = len(Body)
+            self.bytes_written += len(Body)
+        return {'ETag': f'{UploadId}-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.faults.hit('CompleteMultipartUpload')
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = sum(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.faults.hit('AbortMultipartUpload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+# --- Athena / Glue ----------------------------------------------------------------------------
+
+# Queries and job runs take `duration` secs (or a (min, max) range) of wall time and then end up
+# SUCCEEDED, or FAILED for a `failure_rate` share of them. Submissions themselves go through faults.
+class FakeAsyncService:
+
+    def __init__(self, duration=0.05, failure_rate=0, faults=None, seed=None):
+        self.duration = duration
+        self.failure_rate = failure_rate
+        self.faults = faults or Faults()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.runs = {}
+
+    def new_run(self, **details):
+        with self.lock:
+            duration = self.random.uniform(*self.duration) if isinstance(self.duration, tuple) else self.duration
+            run_id = uuid.uuid4().hex
+            self.runs[run_id] = dict(details, started=time.monotonic(), duration=duration,
+                outcome='FAILED' if self.random.random() < self.failure_rate else 'SUCCEEDED', stopped=False)
+        return run_id
+
+    def state(self, run_id):
+        run = self.runs[run_id]
+        if run['stopped']:
+            return run, 'CANCELLED'
+        if time.monotonic() - run['started'] < run['duration']:
+            return run, 'RUNNING'
+        return run, run['outcome']
+
+    def elapsed_ms(self, run):
+        return int(min(time.monotonic() - run['started'], run['duration']) * 1000)
+
+
+class FakeAthena(FakeAsyncService):
+
+    def start_query_execution(self, QueryString, QueryExecutionContext=None, **kwargs):
+        self.faults.hit('StartQueryExecution')
+        return {'QueryExecutionId': self.new_run(query=QueryString)}
+
+    def execution(self, query_execution_id):
+        run, state = self.state(query_execution_id)
+        status = {'State': state}
+        if state == 'FAILED':
+            status['StateChangeReason'] = 'Injected failure'
+        return {
+            'QueryExecutionId': query_execution_id,
+            'Query': run['query'],
+            'Status': status,
+            'Statistics': {
+                'EngineExecutionTimeInMillis': self.elapsed_ms(run),
+                'DataScannedInBytes': len(run['query']) * 1024,
+                'QueryQueueTimeInMillis': 0
+            }
+        }
+
+    def get_query_execution(self, QueryExecutionId):
+        self.faults.hit('GetQueryExecution')
+        return {'QueryExecution': self.execution(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.faults.hit('BatchGetQueryExecution')
+        return {'QueryExecutions': [self.execution(qid) for qid in QueryExecutionIds], 'UnprocessedQueryExecutionIds': []}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.faults.hit('StopQueryExecution')
+        self.runs[QueryExecutionId]['stopped'] = True
+        return {}
+
+
+class FakeGlue(FakeAsyncService):
+
+    def start_job_run(self, JobName, Arguments=None, **kwargs):
+        self.faults.hit('StartJobRun')
+        return {'JobRunId': self.new_run(job_name=JobName, arguments=Arguments or {})}
+
+    def get_job_run(self, JobName, RunId, **kwargs):
+        self.faults.hit('GetJobRun')
+        run, state = self.state(RunId)
+        job_run = {
+            'Id': RunId,
+            'JobName': JobName,
+            'JobRunState': 'STOPPED' if state == 'CANCELLED' else state,
+            'ExecutionTime': self.elapsed_ms(run) // 1000,
+            'DPUSeconds': self.elapsed_ms(run) / 1000 * 2
+        }
+        if state == 'FAILED':
+            job_run['ErrorMessage'] = 'Injected failure'
+        return {'JobRun': job_run}
+
+
+# --- UtilityAPI -------------------------------------------------------------------------------
+
+# Generated bills / intervals, `records` of them per meter; intervals carry `readings` readings each
+def make_records(file_type, meter, records, readings=96):
+    if file_type == 'intervals':
+        return [{
+            'meter_uid': meter,
+            'readings': [{'start': f'2026-10-{(r % 28) + 1:02d}T{i % 24:02d}:00:00+00:00',
+                          'end': f'2026-10-{(r % 28) + 1:02d}T{i % 24:02d}:15:00+00:00',
+                          'kwh': round((i * 7 + r) % 13 * 0.37, 2)} for i in range(readings)]
+        } for r in range(records)]
+    return [{
+        'meter_uid': meter,
+        'base': {'bill_start_date': f'2026-{(r % 12) + 1:02d}-01T00:00:00+00:00',
+                 'bill_end_date': f'2026-{(r % 12) + 1:02d}-28T00:00:00+00:00',
+                 'bill_total_kwh': 400 + r, 'bill_total_cost': 80.5 + r}
+    } for r in range(records)]
+
+
+# A local HTTP server answering /api/v2/<file_type>?meters=..&utility=.. like UtilityAPI does.
+# Injected failures answer with faults.error_code (an HTTP status); 429s carry a short Retry-After.
+class FakeUtilityApi:
+
+    def __init__(self, records=12, readings=96, faults=None):
+        self.faults = faults or Faults(error_code=503)
+        self.records = records
+        self.readings = readings
+        self.server = None
+        self.thread = None
+
+    def start(self):
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                start = time.perf_counter()
+                delay = api.faults.delay()
+                if delay:
+                    time.sleep(delay)
+                url = urlparse(self.path)
+                file_type = url.path.rstrip('/').split('/')[-1]
+                meter = parse_qs(url.query).get('meters', [''])[0]
+                api.faults.record(file_type, time.perf_counter() - start)
+
+                if api.faults.should_fail():
+                    self.send_response(int(api.faults.error_code))
+                    if int(api.faults.error_code) == 429:
+                        self.send_header('Retry-After', '0.05')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = json.dumps({file_type: make_records(file_type, meter, api.records, api.readings)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/api/v2'
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def meter_ids(count, start=780000):
+    return [str(meter) for meter in itertools.islice(itertools.count(start), count)]
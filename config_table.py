@@ -0,0 +1,338 @@
+import json
+import logging
+import os
+import time
+import uuid
+from collections import namedtuple
+from decimal import Decimal
+
+import aws_clients
+import metrics
+
+
+# What the three lambdas share about the c2c config table: its Table resource, the codec for its
+# item shapes, the cached per file_type config row, the compact schedule items and the
+# idempotency records p2 and p3 keep in it. Packaged with aws_clients.py and metrics.py as the
+# lambdas' layer (lambdas/build_layer.py).
+
+# c2c_config_table to get all the lambda configuration.
+TABLE_NAME = os.environ['config_table_name']
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def get_config_table():
+    return aws_clients.get_table(TABLE_NAME)
+
+
+# except clauses look ClientError up when they are reached, botocore is loaded by then anyway
+def client_error():
+    from botocore.exceptions import ClientError
+    return ClientError
+
+
+# Codec for the config table's own item shapes. Typed items from the low-level client are decoded
+# directly, without a TypeDeserializer: numbers come back as native ints (Decimal only when they
+# have a fraction), and schedule items become compact ScheduleItem records whichever form they
+# are stored in.
+def decode_value(typed):
+    kind, value = next(iter(typed.items()))
+    if kind == 'S' or kind == 'BOOL' or kind == 'B':
+        return value
+    if kind == 'N':
+        return int(value) if value.lstrip('-').isdigit() else Decimal(value)
+    if kind == 'M':
+        return {k: decode_value(v) for k, v in value.items()}
+    if kind == 'L':
+        return [decode_value(v) for v in value]
+    if kind == 'NULL':
+        return None
+    if kind == 'NS':
+        return {decode_value({'N': v}) for v in value}
+    return set(value)
+
+
+# Converts Dynmo object to json
+def from_dynamodb_to_json(item):
+    return {k: decode_value(v) for k, v in item.items()}
+
+
+# legacy: stored as a schd_day list, not yet migrated to next_slot
+ScheduleItem = namedtuple('ScheduleItem', 'file_type load_date processing_flag frequency slot_count next_slot legacy')
+
+
+def decode_schedule_item(typed):
+
+    if 'next_slot' in typed:
+        slot_count, next_slot, legacy = int(typed['slot_count']['N']), int(typed['next_slot']['N']), False
+    else:
+        schd_day = typed['schd_day']['L']
+        slot_count = len(schd_day)
+        next_slot = min((int(slot['M']['schd_id']['N']) for slot in schd_day if slot['M']['status']['S'] == 'q'), default=slot_count + 1)
+        legacy = True
+
+    return ScheduleItem(
+        typed['file_type']['S'],
+        typed['load_date']['S'],
+        typed.get('processing_flag', {}).get('S'),
+        typed.get('frequency', {}).get('S'),
+        slot_count,
+        next_slot,
+        legacy
+    )
+
+
+# Funciton to get the config from Dynamo table based on file_type and date
+@metrics.timed('dynamodb_read')
+def get_dynamo_table_data(file_type, load_date):
+
+    response = aws_clients.get_client('dynamodb').query(
+        TableName=TABLE_NAME,
+        KeyConditionExpression='file_type = :f and load_date = :sd ',
+        ExpressionAttributeValues={
+            ':f': {'S': file_type},
+            ':sd' : {'S': load_date}
+        }
+    )
+    
+    return response['Items']
+
+# The '2999-12-31' row holds the static per file_type config. It is cached across warm
+# invocations. An event that carries the row's config_version (p1's fan-out mode reads the row
+# anyway) decides by itself whether the cached row is current. Otherwise, after CONFIG_CACHE_TTL
+# secs only its config_version is re-read, and the full row is fetched again when that version
+# changed. A row without a config_version cannot tell whether it changed, so it is fetched again
+# in full. The TTL is longer than the 15 minutes between two slots of a file_type, or every warm
+# invocation would find it expired.
+CONFIG_LOAD_DATE = '2999-12-31'
+CONFIG_CACHE_TTL = int(os.environ.get('config_cache_ttl', 3600))
+_config_cache = {}
+
+
+@metrics.timed('dynamodb_read')
+def get_config_version(file_type):
+
+    response = aws_clients.get_client('dynamodb').get_item(
+        TableName=TABLE_NAME,
+        Key={
+            'file_type': {'S': file_type},
+            'load_date': {'S': CONFIG_LOAD_DATE}
+        },
+        ProjectionExpression='config_version'
+    )
+
+    version = response.get('Item', {}).get('config_version')
+    return next(iter(version.values())) if version else None
+
+
+def get_file_type_config(file_type, config_version=None):
+
+    cached = _config_cache.get(file_type)
+    now = time.monotonic()
+
+    if cached:
+        if config_version is not None:
+            if str(config_version) != cached['version']:
+                cached = None
+        elif now - cached['fetched_at'] >= CONFIG_CACHE_TTL:
+            version = get_config_version(file_type)
+            if version is not None and version == cached['version']:
+                cached['fetched_at'] = now
+            else:
+                cached = None
+
+    if not cached:
+        logger.info(f"Loading the config for file_type: {file_type}")
+        file_type_config = from_dynamodb_to_json(get_dynamo_table_data(file_type, CONFIG_LOAD_DATE)[0])
+        version = file_type_config.get('config_version')
+        cached = {
+            'config': file_type_config,
+            'version': str(version) if version is not None else None,
+            'fetched_at': now
+        }
+        _config_cache[file_type] = cached
+
+    return cached['config']
+
+
+# Compact schedule model: instead of the 96 (or 24) entry schd_day list, a schedule item keeps
+# slot_count and next_slot, the schd_id of the first queued slot (slot_count + 1 once the day is done).
+# Advancing a slot is one conditional update on next_slot, so two invocations can never both
+# advance the same slot, and the write is charged for a small item only.
+
+def is_conditional_check_failure(e):
+    return e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+# Converts a legacy schd_day item into the compact form, the first queued slot
+# becomes next_slot
+@metrics.timed('dynamodb_write')
+def migrate_schedule_item(file_type, load_date, item):
+
+    logger.info(f"Migrating the schedule of {file_type}/{load_date} to next_slot: {item.next_slot}, slot_count: {item.slot_count}")
+    try:
+        get_config_table().update_item(
+            Key={
+                'file_type': file_type,
+                'load_date': load_date
+            },
+            UpdateExpression='SET next_slot = :ns, slot_count = :sc REMOVE schd_day',
+            ConditionExpression='attribute_not_exists(next_slot)',
+            ExpressionAttributeValues={
+                ':ns': item.next_slot,
+                ':sc': item.slot_count
+            }
+        )
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+        # Migrated by someone else in the meantime, theirs wins
+        return decode_schedule_item(get_dynamo_table_data(file_type, load_date)[0])
+
+    return item._replace(legacy=False)
+
+
+def load_schedule_item(file_type, load_date):
+
+    item = decode_schedule_item(get_dynamo_table_data(file_type, load_date)[0])
+    if item.legacy:
+        item = migrate_schedule_item(file_type, load_date, item)
+    return item
+
+
+# Marks `slots` slots from schd_id on as processed, only if schd_id still is the next queued slot
+@metrics.timed('dynamodb_write')
+def advance_slot(file_type, load_date, schd_id, slot_count, slots=1):
+
+    processing_flag = 'N' if schd_id + slots - 1 >= slot_count else 'Y'
+
+    return get_config_table().update_item(
+        Key={
+            'file_type': file_type,
+            'load_date': load_date
+        },
+        UpdateExpression='SET next_slot = next_slot + :one, processing_flag = :pf',
+        ConditionExpression='next_slot = :expected',
+        ExpressionAttributeValues={
+            ':one': slots,
+            ':expected': schd_id,
+            ':pf': processing_flag
+        }
+    )
+
+
+def update_schd_status(file_type, load_date, schd_id=None, slot_count=None, slots=1):
+
+    logger.info("updating the status of the DynamoDB table")
+
+    # p1 hands the slot over in the event, older events need the item read first
+    if schd_id is None or slot_count is None:
+        item = load_schedule_item(file_type, load_date)
+        schd_id, slot_count = item.next_slot, item.slot_count
+
+    try:
+        response = advance_slot(file_type, load_date, int(schd_id), int(slot_count), int(slots))
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+        # Either a legacy item that still has to be migrated, or the slot moved on already
+        item = load_schedule_item(file_type, load_date)
+        if item.next_slot != int(schd_id):
+            logger.info(f"Slot {schd_id} of {file_type}/{load_date} was already advanced, next_slot: {item.next_slot}")
+            return False
+        response = advance_slot(file_type, load_date, int(schd_id), item.slot_count, int(slots))
+
+    logger.info(response)
+
+    return True
+
+
+# Idempotency: each p2 / p3 execution of a (file_type, load_date, hour, schd_id) slot runs once.
+# The first invocation takes a lease on it with a conditional put; a duplicate delivery gets the
+# stored outcome back once it COMPLETED, or backs off while it is IN_PROGRESS. A lease that ran
+# out (the owner crashed) can be taken over, and a failed execution releases its lease so that
+# a retry runs again. Records live in the config table under their own file_type.
+IDEMPOTENCY_FILE_TYPE = 'idempotency'
+IDEMPOTENCY_TTL = int(os.environ.get('idempotency_ttl', 7 * 86400))
+
+
+def idempotency_key(stage, body):
+    return '|'.join([stage] + [str(body.get(k)) for k in ('file_type', 'load_date', 'hour', 'schd_id')])
+
+
+# Returns (lease_token, None) when this invocation owns the execution, (None, record) when it does not.
+# The lease runs for lease secs, the longest the stage can take.
+@metrics.timed('dynamodb_write')
+def claim_execution(key, lease):
+
+    for _ in range(2):
+        token = uuid.uuid4().hex
+        now = int(time.time())
+        try:
+            get_config_table().put_item(
+                Item={
+                    'file_type': IDEMPOTENCY_FILE_TYPE,
+                    'load_date': key,
+                    'execution_status': 'IN_PROGRESS',
+                    'lease_token': token,
+                    'lease_expires_at': now + lease,
+                    # DynamoDB TTL attribute
+                    'expires_at': now + IDEMPOTENCY_TTL
+                },
+                ConditionExpression='attribute_not_exists(load_date) or '
+                                    '(execution_status = :in_progress and lease_expires_at < :now)',
+                ExpressionAttributeValues={':in_progress': 'IN_PROGRESS', ':now': now}
+            )
+            return token, None
+        except client_error() as e:
+            if not is_conditional_check_failure(e):
+                raise
+
+        record = get_config_table().get_item(
+            Key={'file_type': IDEMPOTENCY_FILE_TYPE, 'load_date': key},
+            ConsistentRead=True
+        ).get('Item')
+        # Otherwise released in between, try to take it once more
+        if record is not None:
+            return None, record
+
+    return None, {'execution_status': 'IN_PROGRESS'}
+
+
+# Stores the outcome, as long as the lease was not taken over in the meantime
+@metrics.timed('dynamodb_write')
+def complete_execution(key, token, outcome):
+    try:
+        get_config_table().update_item(
+            Key={'file_type': IDEMPOTENCY_FILE_TYPE, 'load_date': key},
+            UpdateExpression='SET execution_status = :completed, execution_outcome = :outcome REMOVE lease_expires_at',
+            ConditionExpression='lease_token = :token',
+            ExpressionAttributeValues={':completed': 'COMPLETED', ':outcome': json.dumps(outcome), ':token': token}
+        )
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.info(f"Lease on {key} was taken over, not storing the outcome")
+
+
+@metrics.timed('dynamodb_write')
+def release_execution(key, token):
+    try:
+        get_config_table().delete_item(
+            Key={'file_type': IDEMPOTENCY_FILE_TYPE, 'load_date': key},
+            ConditionExpression='lease_token = :token',
+            ExpressionAttributeValues={':token': token}
+        )
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+
+
+# When several file types share a slot, what they do together (the handler, the polling, a batch
+# Glue run) is measured without a file_type; the work of each one is measured under its own
+def set_slot_dimensions(slots):
+    if not slots:
+        return metrics.set_dimensions()
+    file_types = {slot['file_type'] for slot in slots}
+    metrics.set_dimensions(file_type=file_types.pop() if len(file_types) == 1 else None,
+                           load_date=slots[0]['load_date'], hour=slots[0]['hour'])
@@ -0,0 +1,219 @@
+import argparse
+import fileinput
+import json
+import statistics
+import sys
+from collections import defaultdict
+
+
+# Cost report over the engine statistics records p2 and p3 log for every Athena query and Glue
+# run (record "athena_query" / "glue_run", one JSON line each, labelled with file_type, load_date,
+# hour and query). Reads Lambda log lines from files or stdin, e.g. exported with
+#
+#   aws logs filter-log-events --log-group-name /aws/lambda/lmd_iib_c2c_athena_query_runner_p2 \
+#       --filter-pattern '{ $.record = "athena_query" }' --query 'events[].message' --output text
+#
+# and prints, per load_date and file_type, what was scanned and what it cost, then flags
+# regressions: executions of a query that scanned (or ran, or used DPUs) far more than the same
+# query usually does. insert scanning 10x its usual bytes usually means partition pruning failed.
+#
+#   python cost_report.py p2.log p3.log [--days 1] [--baseline-days 7] [--factor 3]
+
+# Athena bills every query for at least 10 MB scanned, except DDL (partition statements among
+# them) and failed queries, which are not billed at all. Cancelled queries are billed for what
+# they scanned; p2 records the queries it terminates at their deadline as CANCELLED.
+ATHENA_MIN_BYTES = 10 * 1024 * 1024
+ATHENA_UNBILLED_STATEMENTS = ('DDL', 'UTILITY')
+TB = 1024 ** 4
+
+# (record, statistic) compared against the query's own baseline
+CHECKS = [
+    ('athena_query', 'DataScannedInBytes'),
+    ('athena_query', 'EngineExecutionTimeInMillis'),
+    ('glue_run', 'DPUSeconds'),
+]
+# Below these an execution is too small to be worth a flag, whatever the ratio
+CHECK_FLOORS = {
+    'DataScannedInBytes': ATHENA_MIN_BYTES,
+    'EngineExecutionTimeInMillis': 5000,
+    'DPUSeconds': 60,
+}
+
+
+# Statistics records out of log lines; anything else (plain log output, timer metrics) is skipped.
+# `--output text` prints the messages of a page on one line separated by tabs, which a JSON line
+# never contains unescaped, so every line is split on them first.
+def read_records(lines):
+
+    records = []
+    for message in (message for line in lines for message in line.split('\t')):
+        start = message.find('{')
+        if start < 0 or '"record"' not in message:
+            continue
+        try:
+            record = json.loads(message[start:])
+        except ValueError:
+            continue
+        if record.get('record') in ('athena_query', 'glue_run') and record.get('load_date'):
+            records.append(record)
+    return records
+
+
+def athena_billed(record):
+    if record.get('state') == 'FAILED':
+        return False
+    if record.get('statement_type'):
+        return record['statement_type'] not in ATHENA_UNBILLED_STATEMENTS
+    # Records without a statement_type: the partition DDL p2 runs is named after it
+    return 'partition' not in str(record.get('query', ''))
+
+
+# Glue batch runs are logged with each file_type's share of the DPUSeconds already
+def execution_cost(record, args):
+    if record['record'] == 'athena_query':
+        if not athena_billed(record):
+            return 0
+        return max(record.get('DataScannedInBytes', 0), ATHENA_MIN_BYTES) / TB * args.athena_price_per_tb
+    return record.get('DPUSeconds', 0) / 3600 * args.dpu_hour_price
+
+
+# {(load_date, file_type): totals}
+def daily_totals(records, args):
+
+    totals = defaultdict(lambda: defaultdict(float))
+    for record in records:
+        day = totals[(record['load_date'], record.get('file_type', '-'))]
+        day['cost'] += execution_cost(record, args)
+        if record['record'] == 'athena_query':
+            day['queries'] += 1
+            day['scanned_bytes'] += record.get('DataScannedInBytes', 0)
+            day['engine_ms'] += record.get('EngineExecutionTimeInMillis', 0)
+            day['queue_ms'] += record.get('QueryQueueTimeInMillis', 0)
+        else:
+            day['glue_runs'] += 1
+            day['dpu_seconds'] += record.get('DPUSeconds', 0)
+    return totals
+
+
+# Splits the load_dates into the report window (the latest `days`) and the baseline before it
+def split_days(records, days, baseline_days):
+    load_dates = sorted({record['load_date'] for record in records})
+    window = load_dates[-days:]
+    baseline = load_dates[:-days][-baseline_days:] if baseline_days else load_dates[:-days]
+    return set(window), set(baseline)
+
+
+# Executions in the window that exceed `factor` times the median of the same
+# (file_type, query) over the baseline days, grouped per (file_type, query, statistic)
+def find_regressions(records, window, baseline, args):
+
+    baseline_values = defaultdict(list)
+    for record in records:
+        if record['load_date'] in baseline:
+            for kind, statistic in CHECKS:
+                if record['record'] == kind and statistic in record:
+                    baseline_values[(record.get('file_type'), record.get('query'), statistic)].append(record[statistic])
+
+    regressions = {}
+    for record in records:
+        if record['load_date'] not in window:
+            continue
+        for kind, statistic in CHECKS:
+            key = (record.get('file_type'), record.get('query'), statistic)
+            if record['record'] != kind or statistic not in record or not baseline_values.get(key):
+                continue
+            median = statistics.median(baseline_values[key])
+            value = record[statistic]
+            if value < CHECK_FLOORS[statistic] or value <= args.factor * max(median, 1):
+                continue
+
+            ratio = value / max(median, 1)
+            regression = regressions.setdefault(key, {
+                'file_type': key[0], 'query': key[1], 'statistic': statistic,
+                'baseline_median': median, 'executions': 0, 'worst_ratio': 0
+            })
+            regression['executions'] += 1
+            if ratio > regression['worst_ratio']:
+                regression.update(worst_ratio=round(ratio, 1), worst_value=value, load_date=record['load_date'],
+                                  hour=record.get('hour'),
+                                  execution_id=record.get('query_execution_id') or record.get('job_run_id'))
+
+    return sorted(regressions.values(), key=lambda r: -r['worst_ratio'])
+
+
+def human_bytes(value):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if value < 1024 or unit == 'TiB':
+            return f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def print_report(totals, regressions, window):
+
+    print(f"{'load_date':<12} {'file_type':<20} {'queries':>8} {'scanned':>12} {'engine s':>10} "
+          f"{'queue s':>9} {'glue runs':>10} {'DPU-h':>8} {'cost $':>9}")
+    for (load_date, file_type), day in sorted(totals.items()):
+        marker = '*' if load_date in window else ' '
+        print(f"{load_date:<11}{marker} {file_type:<20} {int(day['queries']):>8} {human_bytes(day['scanned_bytes']):>12} "
+              f"{day['engine_ms'] / 1000:>10.1f} {day['queue_ms'] / 1000:>9.1f} {int(day['glue_runs']):>10} "
+              f"{day['dpu_seconds'] / 3600:>8.2f} {day['cost']:>9.4f}")
+
+    per_file_type = defaultdict(float)
+    for (load_date, file_type), day in totals.items():
+        if load_date in window:
+            per_file_type[file_type] += day['cost']
+    print("\nMost expensive file types (* days):")
+    for file_type, cost in sorted(per_file_type.items(), key=lambda item: -item[1]):
+        print(f"  {file_type:<20} ${cost:.4f}")
+
+    if not regressions:
+        print("\nNo regressions")
+        return
+
+    print(f"\nRegressions ({len(regressions)}):")
+    for r in regressions:
+        baseline, worst = r['baseline_median'], r['worst_value']
+        if r['statistic'] == 'DataScannedInBytes':
+            baseline, worst = human_bytes(baseline), human_bytes(worst)
+        print(f"  {r['file_type']}/{r['query']} {r['statistic']}: {r['executions']} executions over the baseline, "
+              f"worst {worst} vs median {baseline} ({r['worst_ratio']}x) at {r['load_date']} hour {r['hour']}, "
+              f"{r['execution_id']}")
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', nargs='*', help='log files with the statistics records (default: stdin)')
+    parser.add_argument('--days', type=int, default=1, help='latest load_dates to report on')
+    parser.add_argument('--baseline-days', type=int, default=7, help='load_dates before those to compare against (0: all)')
+    parser.add_argument('--factor', type=float, default=3.0, help='flag executions above factor x the baseline median')
+    parser.add_argument('--athena-price-per-tb', type=float, default=5.0)
+    parser.add_argument('--dpu-hour-price', type=float, default=0.44)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with 1 when anything is flagged')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    with fileinput.input(args.logs) as lines:
+        records = read_records(lines)
+    if not records:
+        sys.exit("No statistics records found")
+
+    window, baseline = split_days(records, args.days, args.baseline_days)
+    totals = daily_totals(records, args)
+    regressions = find_regressions(records, window, baseline, args)
+
+    if args.json:
+        print(json.dumps({
+            'days': [dict(day, load_date=load_date, file_type=file_type) for (load_date, file_type), day in sorted(totals.items())],
+            'regressions': regressions
+        }, indent=2))
+    else:
+        print_report(totals, regressions, window)
+
+    if args.fail_on_regression and regressions:
+        sys.exit(1)
@@ -0,0 +1,23 @@
+import os
+import sys
+import zipfile
+
+
+# Packages the modules the three lambdas share (aws_clients.py, metrics.py, config_table.py and
+# athena_poller.py from the repo root) as a Lambda layer zip. Layer contents land in /opt, and
+# /opt/python is on the lambdas' sys.path, so each module goes under python/.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ('aws_clients.py', 'metrics.py', 'config_table.py', 'athena_poller.py')
+DEFAULT_OUTPUT = os.path.join(ROOT, 'build', 'c2c_common_layer.zip')
+
+
+def build_layer(output=DEFAULT_OUTPUT):
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as layer:
+        for module in MODULES:
+            layer.write(os.path.join(ROOT, module), 'python/' + module)
+    return output
+
+
+if __name__ == '__main__':
+    print(build_layer(*sys.argv[1:2]))
@@ -1,132 +1,77 @@
 import json
 import time
-from timeit import default_timer as timer
-import boto3
-from boto3.dynamodb.types import TypeDeserializer
 import logging
 import os
 
+# Shared with main.py and p1 / p3 through the lambdas' layer (lambdas/build_layer.py)
+import athena_poller
+import metrics
+from aws_clients import get_client
+from config_table import (
+    claim_execution, client_error, complete_execution, get_config_table, get_file_type_config,
+    idempotency_key, is_conditional_check_failure, release_execution, set_slot_dimensions, update_schd_status
+)
 
-# DynamoDB boto3 handles
-dynamoDB_client = boto3.client('dynamodb')
-dynamodb_resource = boto3.resource('dynamodb')
+# Adaptive polling (athena_poller): first check after ~INITIAL_POLL_INTERVAL secs, then exponential
+# backoff with jitter up to MAX_POLL_INTERVAL, until QUERY_TIMEOUT secs have passed in total. In blocking
+# mode no query runs past the invocation either: DEADLINE_MARGIN secs before Lambda would kill it,
+# running queries are terminated and their slots failed, so they stay queued for a retry.
+INITIAL_POLL_INTERVAL = 0.25
+MAX_POLL_INTERVAL = 10
+QUERY_TIMEOUT = int(os.environ.get('query_timeout', 600))
+DEADLINE_MARGIN = int(os.environ.get('deadline_margin', 30))
+TERMINAL_STATES = athena_poller.TERMINAL_STATES
 
-# c2c_config_table to get all the lambda configuration.
-dyn_c2c_config_table_name = os.environ['config_table_name']
-c2c_pipeline_config = dynamodb_resource.Table(dyn_c2c_config_table_name)
+# 'blocking' waits on every query inside the invocation. 'resumable' submits a stage of queries,
+# saves a continuation and returns; a later invocation (a Step Functions loop passing the
+# continuation back in, or the Athena "Query State Change" EventBridge event) picks up from there.
+EXECUTION_MODE = os.environ.get('execution_mode', 'blocking')
 
-# number of retries
-RETRY_COUNT = 10
+# Continuations are kept in the config table under their own file_type, one item per running query id
+CONTINUATION_FILE_TYPE = 'p2_continuation'
 
-# Sleep time for retries
-SLEEP_TIME = 10
-
-# Get the athena client handle
-athena_client = boto3.client('athena')
-
-# Get the s3 resource handle
-s3_resource = boto3.resource('s3')
+# Idempotency of each slot's p2 execution (see config_table.py); the lease covers the longest a
+# slot's queries can take
+IDEMPOTENCY = os.environ.get('idempotency', 'Y') == 'Y'
+IDEMPOTENCY_LEASE = int(os.environ.get('idempotency_lease', 3600))
 
+# Queries of a slot (or of several file types sharing one) that may run on Athena at the same time
+ATHENA_CONCURRENCY = int(os.environ.get('athena_concurrency', 5))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Response body
-response_body = {}
-
 
 # A util Lambda
 addQuote = lambda x: f"'{x}'"
 
-# Converts Dynmo object to json
-def from_dynamodb_to_json(item):
-    d = TypeDeserializer()
-    return {k: d.deserialize(value=v) for k, v in item.items()}
 
+# Stops a query and returns its execution as it stands after the stop: Athena still bills a
+# cancelled query for the data it scanned, so its statistics are recorded too
+def terminate_query(query_execution_id):
+    athena = get_client('athena')
+    athena.stop_query_execution(QueryExecutionId=query_execution_id)
+    return athena.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
 
-# Funciton to get the config from Dynamo table based on file_type and date
-def get_dynamo_table_data(file_type, load_date):
-
-    response = dynamoDB_client.query(
-        TableName=dyn_c2c_config_table_name,
-        KeyConditionExpression='file_type = :f and load_date = :sd ',
-        ExpressionAttributeValues={
-            ':f': {'S': file_type},
-            ':sd' : {'S': load_date}
-        }
-    )
-    
-    return response['Items']
 
+@metrics.timed('athena_status')
+def get_query_executions(query_execution_ids):
+    return athena_poller.get_query_executions(get_client('athena'), query_execution_ids)
 
-def update_schd_status(file_type, load_date):
-    
-    logger.info("updating the status of the DynamoDB table")
-    # Get the day's schedule list
-    schedule_before = from_dynamodb_to_json(get_dynamo_table_data(file_type,load_date)[0])['schd_day']
-    
-    # update the schd list to update the status of the schd
-    schedule = sorted(schedule_before, key = lambda items: items['schd_id'] if items['status']=='q' else 9999999)[0]
-    schedule_before.remove(schedule)
-    schedule['status'] = 's'
-    processing_flag = 'N' if schedule['schd_id'] == 96 or schedule['schd_id'] == 24  else 'Y'
-    schedule_after = [schedule]
-    [schedule_after.append(i) for i in schedule_before]
-    
-    # API call to update the Dynamo table config
-    response = c2c_pipeline_config.update_item(
-    Key={
-        'file_type': file_type,
-        'load_date': load_date
-    },
-    UpdateExpression='SET schd_day = :val, processing_flag = :pf',
-    ExpressionAttributeValues={
-        ':val': schedule_after,
-        ':pf': processing_flag
-    }
-    )
-    
-    logger.info(response)
-    
-    return True
 
+def state_of(executions, query_execution_id):
+    return athena_poller.state_of(executions.get(query_execution_id))
 
-def terminate_query(query_execution_id):
-    query_execution_status = get_status(athena_client, query_execution_id)
-    athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
-    
 
-def status_check(query_execution_id):
-    
-    global RETRY_COUNT
-    
-    while(RETRY_COUNT > 0):
-        logger.info(f"RETRY_COUNT: {RETRY_COUNT}")
-        logger.info(f"Sleeping for {str(SLEEP_TIME)} secs before checking the status!!")
-        time.sleep(SLEEP_TIME)
-        logger.info("Checking the status now!!")
-        
-        # Get query_execution_status
-        query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-        query_execution_status = query_status['QueryExecution']['Status']['State']
-        query_status_reason = query_status['QueryExecution']['Status'].get('StateChangeReason', 'No StateChangeReason')
-        
-        if (query_execution_status == 'QUEUED' or query_execution_status == 'RUNNING'):
-            # Increment the retry count
-            RETRY_COUNT -= 1
-
-        elif query_execution_status == 'FAILED':
-            exception_message ="query_execution_id - " + query_execution_id + " Failed!! " + "\nReason: " + query_status_reason
-            raise Exception(exception_message)
-        elif query_execution_status == 'SUCCEEDED':
-            logger.info("The Query Succeeded")
-            return query_execution_status
-        else:
-            logger.info("None of the conditions met terminating the query!!")
-            terminate_query(query_execution_id)
-            return "TERMINATED"
+@metrics.timed('athena_wait')
+def wait_for_queries(query_execution_ids, timeout=QUERY_TIMEOUT, first_completed=False):
+    logger.info(f"Waiting on {len(query_execution_ids)} queries!!")
+    return athena_poller.wait_for_queries(get_client('athena'), query_execution_ids, timeout=timeout,
+                                          initial_interval=INITIAL_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                                          first_completed=first_completed)
 
 
+@metrics.timed('athena_submit')
 def athena_query_runner(query, database):
     
     logger.info("Submitting the query!!")
@@ -134,82 +79,514 @@ def athena_query_runner(query, database):
     query_execution_id = None
     # Execution
     try:
-        response = athena_client.start_query_execution(
+        response = get_client('athena').start_query_execution(
             QueryString=query,
             QueryExecutionContext={
                 'Database': database
             }
         )
         query_execution_id = response['QueryExecutionId']
-    except InternalServerException as e:
+    except get_client('athena').exceptions.InternalServerException:
         exception_message = "Encountered InternalServerException!!"
         logger.info(f"exception_message : {exception_message}, The query_execution_id will remain None")
-    finally:
-        logger.info(f"query_execution_id: {query_execution_id}")
-        return query_execution_id
-        
+    logger.info(f"query_execution_id: {query_execution_id}")
+    return query_execution_id
+
+
+# The slot a p1 body asks for, with everything needed to build its queries and finish it later
+def build_slot(body):
+
+    file_type_config = get_file_type_config(body['file_type'], body.get('config_version'))
+    hour = body['hour']
+
+    return {
+        'file_type': body['file_type'],
+        'load_date': body['load_date'],
+        'hour': hour,
+        # Catch-up: p1 found catchup_slots overdue slots spanning the hours hour..hour_end
+        'hour_end': body.get('hour_end') or hour,
+        'catchup_slots': int(body.get('catchup_slots') or 1),
+        # The slot p1 picked, handed on to p3 so it can advance exactly that one
+        'schd_id': body.get('schd_id'),
+        'slot_count': body.get('slot_count'),
+        'config_version': body.get('config_version'),
+        'glue_export_flag': bool(file_type_config.get('glue_export_flag'))
+    }
+
+
+# Query DAG of one slot, as {name: {'query', 'database', 'depends_on'}} with names prefixed by
+# file_type so several file types can share one DAG.
+#
+# A config row can declare its own DAG as a 'queries' list of {name, sql, depends_on, database}
+# whose sql templates get source_table, target_table, table_name, load_date, hour, hour_start and
+# hour_end. Without it the DAG is: partition DDL for every hour of the slot, then either one
+# insert_range_sql over the whole hour range or one insert_sql per hour after its own partition.
+# What the statistics of a query are recorded under: its name without the hour, e.g. insert,
+# so the same query can be compared across hours and days
+def query_labels(slot, query, hour):
+    return {'file_type': slot['file_type'], 'load_date': slot['load_date'], 'hour': hour, 'query': query}
+
+
+def put_query_statistics(labels, execution, state=None):
+    statistics = execution.get('Statistics', {})
+    metrics.put_statistics('athena_query', labels, {
+        'DataScannedInBytes': (statistics.get('DataScannedInBytes', 0), 'Bytes'),
+        'EngineExecutionTimeInMillis': (statistics.get('EngineExecutionTimeInMillis', 0), 'Milliseconds'),
+        'QueryQueueTimeInMillis': (statistics.get('QueryQueueTimeInMillis', 0), 'Milliseconds')
+    }, query_execution_id=execution['QueryExecutionId'], state=state or execution['Status']['State'],
+       statement_type=execution.get('StatementType'))
+
+
+def build_query_dag(slot):
+
+    file_type_config = get_file_type_config(slot['file_type'])
+    source_table = file_type_config['source_table']
+    target_table = file_type_config['target_table']
+    database = file_type_config['database']
+    load_date, hour, hour_end = slot['load_date'], slot['hour'], slot['hour_end']
+    prefix = slot['file_type'] + ':'
+
+    if file_type_config.get('queries'):
+        params = {
+            'source_table': source_table,
+            'target_table': target_table,
+            'table_name': source_table,
+            'load_date': addQuote(load_date),
+            'hour': addQuote(hour),
+            'hour_start': addQuote(hour),
+            'hour_end': addQuote(hour_end)
+        }
+        return {
+            prefix + query['name']: {
+                'query': query['sql'].format(**params),
+                'database': query.get('database', database),
+                'depends_on': [prefix + name for name in query.get('depends_on', [])],
+                'labels': query_labels(slot, query['name'], hour)
+            }
+            for query in file_type_config['queries']
+        }
+
+    hours = [str(h).zfill(2) for h in range(int(hour), int(hour_end) + 1)]
+    nodes = {}
+
+    # source_drop_partition_query = file_type_config['drop_partition'].format(table_name=source_table, load_date=addQuote(load_date), hour=addQuote(hour))
+    # target_add_partition_query = file_type_config['add_partition'].format(table_name=target_table, load_date=addQuote(load_date), hour=addQuote(hour))
+    for h in hours:
+        nodes[prefix + f'add_partition_{h}'] = {
+            'query': file_type_config['add_partition'].format(table_name=source_table, load_date=addQuote(load_date), hour=addQuote(h)),
+            'database': database,
+            'depends_on': [],
+            'labels': query_labels(slot, 'add_partition', h)
+        }
+
+    if len(hours) > 1 and file_type_config.get('insert_range_sql'):
+        nodes[prefix + 'insert_range'] = {
+            'query': file_type_config['insert_range_sql'].format(source_table=source_table, target_table=target_table,
+                load_date=addQuote(load_date), hour_start=addQuote(hour), hour_end=addQuote(hour_end)),
+            'database': database,
+            'depends_on': [prefix + f'add_partition_{h}' for h in hours],
+            'labels': query_labels(slot, 'insert_range', hour)
+        }
+    else:
+        for h in hours:
+            nodes[prefix + f'insert_{h}'] = {
+                'query': file_type_config['insert_sql'].format(source_table=source_table, target_table=target_table, load_date=addQuote(load_date), hour=addQuote(h)),
+                'database': database,
+                'depends_on': [prefix + f'add_partition_{h}'],
+                'labels': query_labels(slot, 'insert', h)
+            }
+
+    return nodes
+
+
+# One step of the DAG executor: books the queries that finished (or ran past their deadline)
+# and submits every query whose dependencies succeeded, up to ATHENA_CONCURRENCY in flight. A
+# query that failed, was cancelled or was terminated at its deadline fails its slot.
+# The state is plain JSON so it can also travel as a continuation.
+def dag_step(state, executions):
+
+    running, done, deadlines = state['running'], state['done'], state['deadlines']
+    failed = state.setdefault('failed', {})
+    out_of_time = state.get('deadline') is not None and time.time() >= state['deadline']
+
+    for name, query_execution_id in list(running.items()):
+        query_execution_status = state_of(executions, query_execution_id)
+        if query_execution_status in TERMINAL_STATES:
+            put_query_statistics(state['nodes'][name].get('labels', {'query': name}), executions[query_execution_id])
+        if query_execution_status == 'FAILED':
+            reason = executions[query_execution_id]['Status'].get('StateChangeReason', 'No StateChangeReason')
+            fail_slot(state, slot_of(name), "query_execution_id - " + query_execution_id + " Failed!! " + "\nReason: " + reason)
+            done[name] = 'FAILED'
+        elif query_execution_status == 'SUCCEEDED':
+            done[name] = 'SUCCEEDED'
+        elif query_execution_status == 'CANCELLED':
+            fail_slot(state, slot_of(name), "query_execution_id - " + query_execution_id + " was cancelled!!")
+            done[name] = 'CANCELLED'
+        elif time.time() >= deadlines[name]:
+            logger.info(f"Query {name} still {query_execution_status} at its deadline, terminating the query!!")
+            execution = terminate_query(query_execution_id)
+            # The stop may not have landed yet, but this is the state the query ends up in
+            put_query_statistics(state['nodes'][name].get('labels', {'query': name}), execution, state='CANCELLED')
+            fail_slot(state, slot_of(name), "query_execution_id - " + query_execution_id + " was terminated at its deadline!!")
+            done[name] = 'TERMINATED'
+        else:
+            continue
+        del running[name]
+
+    for name, node in state['nodes'].items():
+        if out_of_time or len(running) >= ATHENA_CONCURRENCY:
+            break
+        if name in done or name in running or slot_of(name) in failed:
+            continue
+        if all(done.get(dependency) == 'SUCCEEDED' for dependency in node['depends_on']):
+            labels = node.get('labels', {})
+            try:
+                with metrics.dimensions(file_type=labels.get('file_type'), load_date=labels.get('load_date'), hour=labels.get('hour')):
+                    query_execution_id = athena_query_runner(node['query'], node['database'])
+            except Exception as e:
+                fail_slot(state, slot_of(name), f"Query {name} could not be submitted: {e}")
+                continue
+            if query_execution_id is None:
+                fail_slot(state, slot_of(name), f"Query {name} could not be submitted")
+                continue
+            running[name] = query_execution_id
+            deadlines[name] = min(time.time() + QUERY_TIMEOUT, state.get('deadline') or float('inf'))
+
+    if not running:
+        for name in state['nodes']:
+            if name not in done and slot_of(name) not in failed:
+                fail_slot(state, slot_of(name), f"Query {name} was not submitted before the invocation deadline"
+                          if out_of_time else f"Query {name} has unmet dependencies")
+
+    return state
+
+
+# Node names are prefixed with the file_type of their slot
+def slot_of(name):
+    return name.split(':', 1)[0]
+
+
+# A failing query fails its own slot only: the rest of that slot's queries are not submitted,
+# while the other slots' queries carry on and those slots finish as usual
+def fail_slot(state, file_type, reason):
+    logger.error(f"Slot of {file_type} failed: {reason}")
+    state.setdefault('failed', {}).setdefault(file_type, reason)
+
+
+def new_dag_state(slots):
+    state = {'slots': slots, 'nodes': {}, 'running': {}, 'done': {}, 'deadlines': {}, 'failed': {}}
+    for slot in slots:
+        try:
+            with metrics.dimensions(file_type=slot['file_type'], load_date=slot['load_date'], hour=slot['hour']):
+                state['nodes'].update(build_query_dag(slot))
+        except Exception as e:
+            fail_slot(state, slot['file_type'], f"Could not build the queries: {e!r}")
+    return state
+
+
+# What is left of the invocation, less DEADLINE_MARGIN, as a time.time() deadline
+def invocation_deadline(context):
+    if context is None:
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
+
+# Blocking mode: waits inside the invocation, stepping whenever any running query finishes
+def run_query_dag(state):
+
+    dag_step(state, {})
+    while state['running']:
+        timeout = max(0, min(state['deadlines'][name] for name in state['running']) - time.time())
+        executions = wait_for_queries(list(state['running'].values()), timeout=timeout, first_completed=True)
+        dag_step(state, executions)
+    return state
+
+
+# Marks the slot as processed, or hands it on to the Glue export in p3
+def finish_slot(slot, status):
+
+    body = {
+        'file_type': slot['file_type'],
+        'load_date': slot['load_date'],
+        'hour': slot['hour'],
+        'hour_end': slot['hour_end'],
+        'catchup_slots': slot['catchup_slots'],
+        'schd_id': slot['schd_id'],
+        'slot_count': slot['slot_count'],
+        'config_version': slot.get('config_version'),
+        'STATUS': status
+    }
+
+    if slot['glue_export_flag']:
+        body['update_status_flag'] = 'Y'
+        body['trigger_glue_job_flag'] = 'Y'
+    else:
+        update_schd_status(slot['file_type'], slot['load_date'], slot['schd_id'], slot['slot_count'], slot['catchup_slots'])
+        body['update_status_flag'] = 'N'
+
+    return body
+
+
+# Takes the idempotency lease on each slot. Slots that already ran, or are running in another
+# invocation, are left out and answered with their stored outcome instead.
+def claim_slots(slots):
+
+    claimed, skipped = [], []
+    for slot in slots:
+        if not IDEMPOTENCY:
+            claimed.append(slot)
+            continue
+        key = idempotency_key('p2', slot)
+        token, record = claim_execution(key, IDEMPOTENCY_LEASE)
+        if token:
+            claimed.append(dict(slot, idempotency_key=key, idempotency_token=token))
+        else:
+            skipped.append(cached_outcome(key, slot, record))
+    return claimed, skipped
 
+
+def cached_outcome(key, slot, record):
+
+    if record.get('execution_status') == 'COMPLETED':
+        logger.info(f"{key} already ran, returning its outcome")
+        return json.loads(record['execution_outcome'])
+
+    logger.info(f"{key} is running in another invocation")
+    return {
+        'file_type': slot['file_type'],
+        'load_date': slot['load_date'],
+        'hour': slot['hour'],
+        'schd_id': slot['schd_id'],
+        'STATUS': 'IN_PROGRESS',
+        'update_status_flag': 'N',
+        'trigger_glue_job_flag': 'N'
+    }
+
+
+# A failed run gives its leases back, so that the retry runs the slots again. Slots that were
+# finished already keep their stored outcome.
+def release_slots(slots):
+    for slot in slots:
+        if 'idempotency_token' in slot and not slot.get('finished'):
+            release_execution(slot['idempotency_key'], slot['idempotency_token'])
+
+
+# The slot stays queued, so p1 hands it out again; its lease is given back for that retry
+def failed_slot_body(slot, reason):
+    release_slots([slot])
+    return {
+        'file_type': slot['file_type'],
+        'load_date': slot['load_date'],
+        'hour': slot['hour'],
+        'schd_id': slot['schd_id'],
+        'STATUS': 'FAILED',
+        'reason': reason,
+        'update_status_flag': 'N',
+        'trigger_glue_job_flag': 'N'
+    }
+
+
+# Response for the whole event: the slot's own body, or one body per slot when several
+# file types came in together. Each slot is finished on its own; only when all of them
+# failed does the invocation fail.
+def finish_dag(state):
+
+    failed = state.get('failed', {})
+    bodies = []
+    for slot in state['slots']:
+        with metrics.dimensions(file_type=slot['file_type'], load_date=slot['load_date'], hour=slot['hour']):
+            if slot['file_type'] in failed:
+                body = failed_slot_body(slot, failed[slot['file_type']])
+            else:
+                body = finish_slot(slot, 'SUCCEEDED')
+                if 'idempotency_token' in slot:
+                    complete_execution(slot['idempotency_key'], slot['idempotency_token'], body)
+            slot['finished'] = True
+        bodies.append(body)
+
+    if failed and len(failed) == len(state['slots']):
+        raise Exception(f"Every slot failed: {failed}")
+
+    return dag_response(bodies + state.get('skipped', []))
+
+
+def dag_response(bodies):
+
+    for body in bodies:
+        logger.info(f"{body}")
+
+    if len(bodies) == 1:
+        return {
+            'statusCode': 200,
+            'body': bodies[0]
+        }
+
+    return {
+        'statusCode': 200,
+        'body': {
+            'slots': bodies,
+            'STATUS': 'FAILED' if any(b['STATUS'] == 'FAILED' for b in bodies) else 'SUCCEEDED',
+            'update_status_flag': 'Y' if any(b['update_status_flag'] == 'Y' for b in bodies) else 'N',
+            'trigger_glue_job_flag': 'Y' if any(b.get('trigger_glue_job_flag') == 'Y' for b in bodies) else 'N'
+        }
+    }
+
+
+@metrics.timed('dynamodb_write')
+def save_continuation(continuation):
+    expires_at = int(max(continuation['deadlines'].values())) + 86400
+    for query_execution_id in continuation['running'].values():
+        get_config_table().put_item(Item={
+            'file_type': CONTINUATION_FILE_TYPE,
+            'load_date': query_execution_id,
+            'continuation': json.dumps(continuation),
+            # DynamoDB TTL attribute, so abandoned continuations clean themselves up
+            'expires_at': expires_at
+        })
+
+
+@metrics.timed('dynamodb_read')
+def load_continuation(query_execution_id):
+    response = get_config_table().get_item(Key={'file_type': CONTINUATION_FILE_TYPE, 'load_date': query_execution_id})
+    item = response.get('Item')
+    return json.loads(item['continuation']) if item else None
+
+
+# Only one invocation gets to move a continuation on: the one that deletes its first item
+@metrics.timed('dynamodb_write')
+def claim_continuation(continuation):
+
+    query_execution_ids = list(continuation['running'].values())
+    try:
+        get_config_table().delete_item(
+            Key={'file_type': CONTINUATION_FILE_TYPE, 'load_date': query_execution_ids[0]},
+            ConditionExpression='attribute_exists(load_date)'
+        )
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+        return False
+
+    for query_execution_id in query_execution_ids[1:]:
+        get_config_table().delete_item(Key={'file_type': CONTINUATION_FILE_TYPE, 'load_date': query_execution_id})
+    return True
+
+
+# Resumable mode: steps the DAG once without sleeping, then either finishes the slots or saves
+# the continuation and returns. A query that finished before its continuation item was written
+# would never find it from its completion event, so that case is stepped again right away.
+def run_resumable(state):
+
+    while True:
+        executions = get_query_executions(list(state['running'].values())) if state['running'] else {}
+        dag_step(state, executions)
+
+        if not state['running']:
+            return finish_dag(state)
+
+        save_continuation(state)
+        logger.info(f"Running: {state['running']}, done: {state['done']}")
+
+        executions = get_query_executions(list(state['running'].values()))
+        if not any(state_of(executions, qid) in TERMINAL_STATES for qid in state['running'].values()):
+            return {
+                'statusCode': 202,
+                'body': {
+                    'STATUS': 'RUNNING',
+                    'update_status_flag': 'N',
+                    'trigger_glue_job_flag': 'N',
+                    'continuation': state
+                }
+            }
+
+        if not claim_continuation(state):
+            return already_resumed()
+
+
+def already_resumed():
+    logger.info("The continuation was already picked up by another invocation")
+    return {'statusCode': 409, 'body': {'STATUS': 'ALREADY_RESUMED', 'trigger_glue_job_flag': 'N'}}
+
+
+def resume_continuation(continuation):
+    set_slot_dimensions(continuation['slots'])
+    if not claim_continuation(continuation):
+        return already_resumed()
+    try:
+        return run_resumable(continuation)
+    except Exception:
+        release_slots(continuation['slots'])
+        raise
+
+
+# EventBridge "Athena Query State Change": resume whatever was waiting on that query
+def handle_athena_event(event):
+
+    detail = event['detail']
+    if detail.get('currentState') not in TERMINAL_STATES:
+        return {'statusCode': 204, 'body': {'STATUS': 'IGNORED', 'trigger_glue_job_flag': 'N'}}
+
+    continuation = load_continuation(detail['queryExecutionId'])
+    if continuation is None:
+        logger.info(f"No continuation waiting on {detail['queryExecutionId']}")
+        return {'statusCode': 204, 'body': {'STATUS': 'IGNORED', 'trigger_glue_job_flag': 'N'}}
+
+    return resume_continuation(continuation)
+
+
+@metrics.timed('p2_handler')
 def lambda_handler(event, context):
     # TODO implement
 
+    metrics.set_dimensions()
+
+    # Resumable mode: a completion event or a continuation handed back in
+    if event.get('source') == 'aws.athena':
+        return handle_athena_event(event)
+    if 'continuation' in event:
+        return resume_continuation(event['continuation'])
+
     body = event['responsePayload']['body']
-    
-    file_type = body['file_type']
-    load_date = body['load_date']
-    hour = body['hour']
-    
-    response_body['file_type'] = file_type
-    response_body['load_date'] = load_date
-    response_body['hour'] = hour
-    
-    for_logging = {
-            "file_type":body['file_type'],
-            "load_date": body['load_date'],
-            "hour": body['hour'],
-            "query_flag" : body['query_flag']
-        }
-    
-    if body['query_flag'] == 'N':
+
+    # Several file types sharing a slot can come in one event, each with its own p1 body
+    # (p1's fan-out mode sends {"slots": []} when no file_type is due)
+    slot_bodies = body['slots'] if 'slots' in body else [body]
+
+    for slot_body in slot_bodies:
+        for_logging = {
+                "file_type": slot_body['file_type'],
+                "load_date": slot_body['load_date'],
+                "hour": slot_body['hour'],
+                "query_flag" : slot_body['query_flag']
+            }
         logger.info(f"{for_logging}")
+
+    set_slot_dimensions(slot_bodies)
+    slots = [build_slot(slot_body) for slot_body in slot_bodies if slot_body['query_flag'] != 'N']
+
+    if not slots:
         logger.info("Recieved No go for query run.")
         logger.info("Gonna Do Nothing!!")
-        response_body['update_status_flag'] = 'N'
-        response_body['trigger_glue_job_flag'] = 'N'
-        
-    else:
-        
-        logger.info("Recieved signal to proceed")
-        logger.info(f"{for_logging}")
-        # Get the config from the dynamo table c2c_pipeline_config
-        file_type_config = from_dynamodb_to_json(get_dynamo_table_data(file_type, '2999-12-31')[0])
-        
-        
-        source_table = file_type_config['source_table']
-        target_table = file_type_config['target_table']
-        insert_query = file_type_config['insert_sql'].format(source_table=source_table, target_table=target_table, load_date=addQuote(load_date), hour=addQuote(hour))
-        # source_drop_partition_query = file_type_config['drop_partition'].format(table_name=source_table, load_date=addQuote(load_date), hour=addQuote(hour))
-        source_add_partition_query = file_type_config['add_partition'].format(table_name=source_table, load_date=addQuote(load_date), hour=addQuote(hour))
-        # target_add_partition_query = file_type_config['add_partition'].format(table_name=target_table, load_date=addQuote(load_date), hour=addQuote(hour))
-        database = file_type_config['database']
-        
-        queries = [source_add_partition_query, insert_query]
-        
-        for query in queries:
-            query_execution_id = athena_query_runner(query, database)
-            status = status_check(query_execution_id)
-            response_body['STATUS'] = status
-
-
-        if file_type_config.get('glue_export_flag'):
-            response_body['update_status_flag'] = 'Y'
-            response_body['trigger_glue_job_flag'] = 'Y'
-        else:
-            update_schd_status(file_type, load_date)
-            response_body['update_status_flag'] = 'N'
-        
-        logger.info(f"{response_body}")
-
         return {
             'statusCode': 200,
-            'body': response_body
+            'body': dict(body, update_status_flag='N', trigger_glue_job_flag='N')
         }
+
+    logger.info("Recieved signal to proceed")
+    slots, skipped = claim_slots(slots)
+    if not slots:
+        return dag_response(skipped)
+
+    try:
+        state = new_dag_state(slots)
+        state['skipped'] = skipped
+
+        if EXECUTION_MODE == 'resumable':
+            return run_resumable(state)
+
+        state['deadline'] = invocation_deadline(context)
+        run_query_dag(state)
+        return finish_dag(state)
+    except Exception:
+        release_slots(slots)
+        raise
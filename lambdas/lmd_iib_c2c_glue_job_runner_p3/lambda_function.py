@@ -1,87 +1,265 @@
 import json
-import boto3
+import os
 import logging
 import time
-from boto3.dynamodb.types import TypeDeserializer
+import uuid
 
-response_body = {}
+# Shared with main.py and p1 / p2 through the lambdas' layer (lambdas/build_layer.py)
+import metrics
+from aws_clients import get_client
+from config_table import (
+    claim_execution, client_error, complete_execution, get_config_table, get_file_type_config,
+    idempotency_key, is_conditional_check_failure, release_execution, set_slot_dimensions, update_schd_status
+)
 
-# DynamoDB boto3 handles
-dynamoDB_client = boto3.client('dynamodb')
-dynamodb_resource = boto3.resource('dynamodb')
+# Short-interval polling of the Glue run: first check after INITIAL_POLL_INTERVAL secs, doubling
+# up to MAX_POLL_INTERVAL, until GLUE_TIMEOUT secs have passed in total, or until DEADLINE_MARGIN
+# secs before Lambda would kill the invocation. A run still going by then is handed over to the
+# complete path, as in the event mode, and its slot is left as it is until the run is done.
+INITIAL_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 30
+GLUE_TIMEOUT = int(os.environ.get('glue_timeout', 840))
+DEADLINE_MARGIN = int(os.environ.get('deadline_margin', 30))
+GLUE_RUNNING_STATES = ('STARTING', 'RUNNING', 'WAITING')
 
-# c2c_config_table to get all the lambda configuration.
-dyn_c2c_config_table_name = os.environ['config_table_name']
-c2c_pipeline_config = dynamodb_resource.Table(dyn_c2c_config_table_name)
+# 'blocking' waits on the Glue run inside the invocation. 'event' starts the run, records it and
+# returns; the complete path then runs on the Glue "Job State Change" EventBridge event, or on a
+# {"glue_poll": {...}} event that checks the run once (a cheap Step Functions / scheduler loop).
+GLUE_COMPLETION_MODE = os.environ.get('glue_completion_mode', 'blocking')
 
-# number of retries
-RETRY_COUNT = 10
+# Started runs waiting for completion are kept in the config table under their own file_type
+GLUE_RUN_FILE_TYPE = 'p3_glue_run'
 
-# Sleep time for retries
-SLEEP_TIME = 80
+# Batching: with glue_batch_size > 1, slots (of any file type sharing the Glue job) are queued in the
+# config table, one item per slice, and exported by one job run passed the list of slices, once
+# glue_batch_size slices are queued or the oldest has waited glue_batch_max_age secs. A
+# {"glue_flush": "<glue_job_name>"} event (e.g. from a schedule) exports whatever is queued. A slot
+# is advanced as soon as its slice is queued, its Athena stage is done and p1 moves on to the next
+# one; the export is tracked on the queue item. The run holds a lease on its slices and marks them
+# exported once it succeeded, a failed run hands them back to the queue and a lease that is never
+# settled runs out, so the queue re-exports them rather than p1 handing the slots out again.
+# Exported slices stay until the DynamoDB TTL removes them, so a late redelivery of the slot does
+# not queue it again.
+GLUE_BATCH_SIZE = int(os.environ.get('glue_batch_size', 1))
+GLUE_BATCH_MAX_AGE = int(os.environ.get('glue_batch_max_age', 3600))
+GLUE_BATCH_LEASE = int(os.environ.get('glue_batch_lease', 6 * 3600))
+GLUE_QUEUE_FILE_TYPE = 'p3_glue_queue'
 
-# Import Boto 3 for AWS Glue
-glue_client = boto3.client('glue')
+# Idempotency of each slot's p3 execution (see config_table.py); the lease covers the longest a
+# Glue run can take
+IDEMPOTENCY = os.environ.get('idempotency', 'Y') == 'Y'
+IDEMPOTENCY_LEASE = int(os.environ.get('idempotency_lease', 6 * 3600))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Converts Dynmo object to json
-def from_dynamodb_to_json(item):
-    d = TypeDeserializer()
-    return {k: d.deserialize(value=v) for k, v in item.items()}
 
+@metrics.timed('glue_status')
+def get_job_run(job_run_id, glue_job_name):
 
-# Funciton to get the config from Dynamo table based on file_type and date
-def get_dynamo_table_data(file_type, load_date):
+    response = get_client('glue').get_job_run(JobName=glue_job_name, RunId=job_run_id, PredecessorsIncluded=False)
+    logger.info(f"response: {response}")
+    return response['JobRun']
 
-    response = dynamoDB_client.query(
-        TableName=dyn_c2c_config_table_name,
-        KeyConditionExpression='file_type = :f and load_date = :sd ',
-        ExpressionAttributeValues={
-            ':f': {'S': file_type},
-            ':sd' : {'S': load_date}
-        }
-    )
-    
-    return response['Items']
 
+def get_job_run_state(job_run_id, glue_job_name, slices=None):
 
-def glue_status_check(job_run_id, glue_job_name):
-    
-    global RETRY_COUNT
-    
-    while (RETRY_COUNT > 0):
-        logger.info(f"RETRY_COUNT: {RETRY_COUNT}")
-        time.sleep(SLEEP_TIME)
-        logger.info(f"Sleeping for {str(SLEEP_TIME)} secs before checking the status!!")
+    job_run = get_job_run(job_run_id, glue_job_name)
+    if job_run['JobRunState'] not in GLUE_RUNNING_STATES:
+        put_job_run_statistics(job_run, slices)
+    return job_run['JobRunState'], job_run.get('ErrorMessage', 'No ErrorMessage')
+
+
+# A batch run is recorded once per (file_type, load_date) it exported, with that group's share
+# of the DPUSeconds by slot count, so its cost can be attributed per file_type. ExecutionTime
+# stays the run's own.
+def put_job_run_statistics(job_run, slices=None):
+
+    dpu_seconds = job_run.get('DPUSeconds')
+    if dpu_seconds is None and job_run.get('MaxCapacity'):
+        # DPUSeconds is only reported for auto scaling and Flex runs, the rest run at MaxCapacity
+        dpu_seconds = job_run.get('ExecutionTime', 0) * job_run['MaxCapacity']
+    dpu_seconds = dpu_seconds or 0
+
+    if not slices:
+        metrics.put_statistics('glue_run', dict(metrics.current_dimensions(), query=job_run.get('JobName')), {
+            'ExecutionTime': (job_run.get('ExecutionTime', 0), 'Seconds'),
+            'DPUSeconds': (dpu_seconds, 'Count')
+        }, job_run_id=job_run.get('Id'), state=job_run.get('JobRunState'))
+        return
+
+    groups = {}
+    for slice_ in slices:
+        group = groups.setdefault((slice_['file_type'], slice_['load_date']), {'slots': 0, 'hour': slice_['hour']})
+        group['slots'] += int(slice_.get('catchup_slots') or 1)
+        group['hour'] = min(group['hour'], slice_['hour'])
+    total_slots = sum(group['slots'] for group in groups.values())
+
+    for (file_type, load_date), group in groups.items():
+        share = group['slots'] / total_slots
+        labels = {'file_type': file_type, 'load_date': load_date, 'hour': group['hour'], 'query': job_run.get('JobName')}
+        metrics.put_statistics('glue_run', labels, {
+            'ExecutionTime': (job_run.get('ExecutionTime', 0), 'Seconds'),
+            'DPUSeconds': (round(dpu_seconds * share, 3), 'Count')
+        }, job_run_id=job_run.get('Id'), state=job_run.get('JobRunState'), share=round(share, 4))
+
+
+def check_job_run_state(job_run_id, job_status, error_message):
+
+    if job_status in ('FAILED', 'STOPPING', 'STOPPED', 'TIMEOUT', 'ERROR'):
+        raise Exception(f"job_run_id - {job_run_id} Failed or Stopped or Timedout!!\nReason: {error_message}")
+    elif job_status == 'SUCCEEDED':
+        logger.info(f"The job_run_id - {job_run_id} has {job_status}")
+        return job_status
+    elif job_status not in GLUE_RUNNING_STATES:
+        raise Exception("None of the conditions met!!")
+    return job_status
+
+
+# How long the blocking mode can wait on a run: GLUE_TIMEOUT, bounded by what is left of the invocation
+def wait_timeout(context):
+    if context is None:
+        return GLUE_TIMEOUT
+    return max(0, min(GLUE_TIMEOUT, context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN))
+
+
+# Returns SUCCEEDED, or the state the run is still in when the timeout ran out
+@metrics.timed('glue_wait')
+def glue_status_check(job_run_id, glue_job_name, slices=None, timeout=GLUE_TIMEOUT):
+
+    deadline = time.monotonic() + timeout
+    interval = INITIAL_POLL_INTERVAL
+    status = 'RUNNING'
+
+    while time.monotonic() < deadline:
+        logger.info(f"Sleeping for {str(interval)} secs before checking the status!!")
+        time.sleep(min(interval, max(0, deadline - time.monotonic())))
         logger.info("Checking the status now!!")
-        # Get glue_execution_status
-        response = glue_client.get_job_run(JobName=glue_job_name, RunId=job_run_id, PredecessorsIncluded=False)
-        job_status = response['JobRun']['JobRunState']
-        
-        logger.info(f"response: {response}")
-        
-        if (job_status == 'RUNNING' or job_status == 'STARTING'):
-            # Increment the retry count
-            RETRY_COUNT -= 1
-            # Call the status_check again
-            status = job_status
-        elif (job_status == 'FAILED' or job_status == 'STOPPING' or job_status == 'STOPPED' or job_status == 'TIMEOUT'):
-            status = job_status
-            raise Exception(f"job_run_id - {job_run_id} Failed or Stopped or Timedout!!\nReason: {response['JobRun']['ErrorMessage']}")
-        elif job_status == 'SUCCEEDED':
-            logger.info(f"The job_run_id - {job_run_id} has {job_status}")
-            status = job_status
+
+        job_status, error_message = get_job_run_state(job_run_id, glue_job_name, slices)
+        status = check_job_run_state(job_run_id, job_status, error_message)
+        if status == 'SUCCEEDED':
             break
-        else:
-            status = job_status
-            raise Exception("None of the conditions met!!")
-    
+        interval = min(MAX_POLL_INTERVAL, interval * 2)
+
     return status
-        
 
-def trigger_glue_job(file_type_config, load_date, hour):
+
+@metrics.timed('dynamodb_write')
+def save_glue_run(job_run_id, glue_job_name, body):
+    get_config_table().put_item(Item={
+        'file_type': GLUE_RUN_FILE_TYPE,
+        'load_date': job_run_id,
+        'glue_job_name': glue_job_name,
+        'slot': json.dumps(body),
+        # DynamoDB TTL attribute, so runs that never report back clean themselves up
+        'expires_at': int(time.time()) + 7 * 86400
+    })
+
+
+# Leaves a started run to the complete path: records it and answers with the glue_poll payload
+def hand_over_glue_run(job_run_id, glue_job_name, body, response_body, status):
+    save_glue_run(job_run_id, glue_job_name, body)
+    response_body['STATUS'] = status
+    response_body['glue_poll'] = {'job_run_id': job_run_id, 'glue_job_name': glue_job_name}
+    return {'statusCode': 202, 'body': json.dumps(response_body)}
+
+
+# Deletes the pending run and returns it; only one invocation gets it for a given run id
+@metrics.timed('dynamodb_write')
+def claim_glue_run(job_run_id):
+    try:
+        response = get_config_table().delete_item(
+            Key={'file_type': GLUE_RUN_FILE_TYPE, 'load_date': job_run_id},
+            ConditionExpression='attribute_exists(load_date)',
+            ReturnValues='ALL_OLD'
+        )
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+        return None
+    return response.get('Attributes')
+
+
+# The complete path: the run is done (successfully or not), update the slot it was started for.
+# job_run is the run as the poll saw it; a completion event does not carry the statistics, so
+# then it is read once here.
+def complete_glue_run(job_run_id, job_status, error_message, job_run=None):
+
+    glue_run = claim_glue_run(job_run_id)
+    if glue_run is None:
+        logger.info(f"No pending slot for job_run_id - {job_run_id}, already completed?")
+        return {'statusCode': 204, 'body': json.dumps({'STATUS': 'IGNORED', 'job_run_id': job_run_id})}
+
+    body = json.loads(glue_run['slot'])
+    set_slot_dimensions(body.get('slices') or [body])
+
+    if job_run is None and metrics.statistics_enabled():
+        job_run = get_job_run(job_run_id, glue_run['glue_job_name'])
+    if job_run is not None:
+        put_job_run_statistics(job_run, body.get('slices'))
+
+    try:
+        result = finish_glue_run(job_run_id, job_status, error_message, body)
+    except Exception:
+        if body.get('idempotency_token'):
+            release_execution(body['idempotency_key'], body['idempotency_token'])
+        if body.get('lease_token'):
+            release_glue_batch(body['queue_keys'], body['lease_token'])
+        raise
+
+    # The lease taken when the run was started is held until here
+    if body.get('idempotency_token'):
+        complete_execution(body['idempotency_key'], body['idempotency_token'], result)
+    return result
+
+
+def finish_glue_run(job_run_id, job_status, error_message, body):
+
+    status = check_job_run_state(job_run_id, job_status, error_message)
+
+    if 'slices' in body:
+        settle_glue_batch(body.get('queue_keys', []), body.get('lease_token'))
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'slices': len(body['slices']), 'job_run_id': job_run_id, 'STATUS': status})
+        }
+
+    update_schd_status(body['file_type'], body['load_date'], body.get('schd_id'), body.get('slot_count'), body.get('catchup_slots') or 1)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'file_type': body['file_type'],
+            'load_date': body['load_date'],
+            'hour': body['hour'],
+            'job_run_id': job_run_id,
+            'STATUS': status
+        })
+    }
+
+
+# EventBridge "Glue Job State Change"
+def handle_glue_event(event):
+
+    detail = event['detail']
+    if detail.get('state') in GLUE_RUNNING_STATES:
+        return {'statusCode': 204, 'body': json.dumps({'STATUS': 'IGNORED'})}
+    return complete_glue_run(detail['jobRunId'], detail['state'], detail.get('message', 'No ErrorMessage'))
+
+
+# One cheap status check; hands the same poll payload back while the run is still going
+def handle_glue_poll(glue_poll):
+
+    job_run = get_job_run(glue_poll['job_run_id'], glue_poll['glue_job_name'])
+    job_status = job_run['JobRunState']
+    if job_status in GLUE_RUNNING_STATES:
+        return {'statusCode': 202, 'body': json.dumps({'STATUS': job_status}), 'glue_poll': glue_poll}
+    return complete_glue_run(glue_poll['job_run_id'], job_status, job_run.get('ErrorMessage', 'No ErrorMessage'), job_run)
+
+
+@metrics.timed('glue_start')
+def trigger_glue_job(file_type_config, load_date, hour, hour_end=None):
     
     # 'source_db','mapping_list','target_table','source_table','target_db'
     
@@ -100,13 +278,14 @@ def trigger_glue_job(file_type_config, load_date, hour):
         "source_table": source_table,
         "target_table": target_table,
         "load_date": load_date,
-        "hour": hour
+        "hour": hour,
+        "hour_end": hour_end or hour
     }
     
     logger.info(f'Triggering the Glue_job: {glue_job_name}')
     logger.info(f'glue_job_args: {glue_args}')
 
-    response = glue_client.start_job_run(JobName = glue_job_name,
+    response = get_client('glue').start_job_run(JobName = glue_job_name,
     Arguments={
         '--athena_source_db': athena_source_db,
         '--rds_target_db': rds_target_db,
@@ -114,56 +293,228 @@ def trigger_glue_job(file_type_config, load_date, hour):
         '--target_table': target_table,
         '--glue_mapping': str(glue_mapping),
         '--load_date': load_date,
-        '--hour': hour}
+        '--hour': hour,
+        # Catch-up runs export the hours hour..hour_end in one go
+        '--hour_end': hour_end or hour}
         )
     
     logger.info('## STARTED GLUE JOB: ' + glue_job_name)
     logger.info('## GLUE JOB RUN ID: ' + response['JobRunId'])
     return response
-    
-    
-def update_schd_status(file_type, load_date):
-    
-    logger.info("updating the status of the DynamoDB table")
-    # Get the day's schedule list
-    schedule_before = from_dynamodb_to_json(get_dynamo_table_data(file_type,load_date)[0])['schd_day']
-    
-    # update the schd list to update the status of the schd
-    schedule = sorted(schedule_before, key = lambda items: items['schd_id'] if items['status']=='q' else 9999999)[0]
-    schedule_before.remove(schedule)
-    schedule['status'] = 's'
-    processing_flag = 'N' if schedule['schd_id'] == 96 or schedule['schd_id'] == 24  else 'Y'
-    schedule_after = [schedule]
-    [schedule_after.append(i) for i in schedule_before]
-    
-    # API call to update the Dynamo table config
-    response = c2c_pipeline_config.update_item(
-    Key={
-        'file_type': file_type,
-        'load_date': load_date
-    },
-    UpdateExpression='SET schd_day = :val, processing_flag = :pf',
-    ExpressionAttributeValues={
-        ':val': schedule_after,
-        ':pf': processing_flag
+
+
+# What the Glue job needs to export one slot, the per file_type tables and mapping included
+# so a single run can cover several file types
+def glue_slice(file_type_config, body):
+    return {
+        'file_type': body['file_type'],
+        'load_date': body['load_date'],
+        'hour': body['hour'],
+        'hour_end': body.get('hour_end') or body['hour'],
+        'schd_id': body.get('schd_id'),
+        'slot_count': body.get('slot_count'),
+        'catchup_slots': body.get('catchup_slots') or 1,
+        'athena_source_db': file_type_config.get('athena_source_db'),
+        'rds_target_db': file_type_config.get('rds_target_db'),
+        'source_table': file_type_config.get('athena_source_table'),
+        'target_table': file_type_config.get('rds_target_table'),
+        'glue_mapping': str(file_type_config.get('glue_mapping'))
     }
-    )
-    
-    logger.info(response)
-    
-    return True
-    
-    
-def lambda_handler(event, context):
-    # TODO implement
+
+
+def glue_queue_key(glue_job_name, slice_):
+    return '|'.join([glue_job_name] + [str(slice_.get(k)) for k in ('file_type', 'load_date', 'schd_id')])
+
+
+# One queue item per slice; queueing the same slot again (a redelivery) leaves the item as it is,
+# exported or not
+@metrics.timed('dynamodb_write')
+def enqueue_glue_slice(glue_job_name, slice_):
+    try:
+        get_config_table().put_item(
+            Item={
+                'file_type': GLUE_QUEUE_FILE_TYPE,
+                'load_date': glue_queue_key(glue_job_name, slice_),
+                'glue_job_name': glue_job_name,
+                'slice': json.dumps(slice_),
+                'queued_at': int(time.time())
+            },
+            ConditionExpression='attribute_not_exists(load_date)'
+        )
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+
+
+# The slices queued on the job that are neither exported nor leased by a batch run
+@metrics.timed('dynamodb_read')
+def get_glue_queue(glue_job_name):
+
+    now = int(time.time())
+    query = {
+        'KeyConditionExpression': 'file_type = :f and begins_with(load_date, :job)',
+        'ExpressionAttributeValues': {':f': GLUE_QUEUE_FILE_TYPE, ':job': glue_job_name + '|'},
+        'ConsistentRead': True
+    }
+    items = []
+    while True:
+        response = get_config_table().query(**query)
+        items.extend(response['Items'])
+        if not response.get('LastEvaluatedKey'):
+            break
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return [item for item in items if not item.get('exported_at') and int(item.get('lease_expires_at') or 0) < now]
+
+
+def glue_batch_due(queue):
+    return bool(queue) and (len(queue) >= GLUE_BATCH_SIZE
+                            or int(time.time()) - min(int(item['queued_at']) for item in queue) >= GLUE_BATCH_MAX_AGE)
+
+
+# Leases the queued slices to one batch run: each item is taken with a conditional update, so
+# an item leased by a concurrent flush is left to it. The items stay queued until the run
+# succeeded; a lease that is never settled or released expires after glue_batch_lease secs and
+# the slice goes into the next batch. Returns (lease_token, slices, queue_keys).
+@metrics.timed('dynamodb_write')
+def take_glue_batch(glue_job_name):
+
+    token = uuid.uuid4().hex
+    now = int(time.time())
+    slices, queue_keys = [], []
+
+    for item in get_glue_queue(glue_job_name):
+        try:
+            get_config_table().update_item(
+                Key={'file_type': GLUE_QUEUE_FILE_TYPE, 'load_date': item['load_date']},
+                UpdateExpression='SET lease_token = :token, lease_expires_at = :expires',
+                ConditionExpression='attribute_not_exists(exported_at) and '
+                                    '(attribute_not_exists(lease_expires_at) or lease_expires_at < :now)',
+                ExpressionAttributeValues={':token': token, ':expires': now + GLUE_BATCH_LEASE, ':now': now}
+            )
+        except client_error() as e:
+            if not is_conditional_check_failure(e):
+                raise
+            continue
+        slices.append(json.loads(item['slice']))
+        queue_keys.append(item['load_date'])
+
+    return token, slices, queue_keys
+
+
+# The batch run did not succeed: its slices are queued again for the next batch
+@metrics.timed('dynamodb_write')
+def release_glue_batch(queue_keys, lease_token):
+
+    logger.info(f"Releasing {len(queue_keys)} slices back to the queue")
+    for queue_key in queue_keys:
+        try:
+            get_config_table().update_item(
+                Key={'file_type': GLUE_QUEUE_FILE_TYPE, 'load_date': queue_key},
+                UpdateExpression='REMOVE lease_token, lease_expires_at',
+                ConditionExpression='lease_token = :token',
+                ExpressionAttributeValues={':token': lease_token}
+            )
+        except client_error() as e:
+            if not is_conditional_check_failure(e):
+                raise
+
+
+# The batch run succeeded: marks its slices exported, their slots were advanced when they were queued
+@metrics.timed('dynamodb_write')
+def settle_glue_batch(queue_keys, lease_token):
+
+    now = int(time.time())
+    for queue_key in queue_keys:
+        try:
+            get_config_table().update_item(
+                Key={'file_type': GLUE_QUEUE_FILE_TYPE, 'load_date': queue_key},
+                UpdateExpression='SET exported_at = :now, expires_at = :expires REMOVE lease_token, lease_expires_at',
+                ConditionExpression='lease_token = :token',
+                ExpressionAttributeValues={':now': now, ':expires': now + 2 * 86400, ':token': lease_token}
+            )
+        except client_error() as e:
+            if not is_conditional_check_failure(e):
+                raise
+
+
+@metrics.timed('glue_start')
+def trigger_glue_batch(glue_job_name, slices):
+
+    logger.info(f'Triggering the Glue_job: {glue_job_name} for {len(slices)} slices')
+    response = get_client('glue').start_job_run(JobName=glue_job_name, Arguments={'--slices': json.dumps(slices)})
+    logger.info('## GLUE JOB RUN ID: ' + response['JobRunId'])
+    return response
+
+
+# Starts one run for everything queued on the job and, depending on the completion mode,
+# waits for it or leaves it to the complete path
+def flush_glue_batch(glue_job_name, context=None):
+
+    lease_token, slices, queue_keys = take_glue_batch(glue_job_name)
+    if not slices:
+        return {'statusCode': 204, 'body': json.dumps({'STATUS': 'EMPTY', 'glue_job_name': glue_job_name})}
+    set_slot_dimensions(slices)
+
+    try:
+        glue_response = trigger_glue_batch(glue_job_name, slices)
+    except Exception:
+        release_glue_batch(queue_keys, lease_token)
+        raise
+    job_run_id = glue_response['JobRunId']
+    response_body = {'glue_job_name': glue_job_name, 'slices': len(slices), 'job_run_id': job_run_id}
+    glue_run = {'slices': slices, 'queue_keys': queue_keys, 'lease_token': lease_token}
+
+    if GLUE_COMPLETION_MODE == 'event':
+        return hand_over_glue_run(job_run_id, glue_job_name, glue_run, response_body, 'STARTED')
+
+    try:
+        status = glue_status_check(job_run_id, glue_job_name, slices, wait_timeout(context))
+    except Exception:
+        release_glue_batch(queue_keys, lease_token)
+        raise
+
+    # Still running at the timeout: the complete path settles the lease once the run is done
+    if status != 'SUCCEEDED':
+        return hand_over_glue_run(job_run_id, glue_job_name, glue_run, response_body, status)
+
+    settle_glue_batch(queue_keys, lease_token)
+    response_body['STATUS'] = status
+    return {'statusCode': 200, 'body': json.dumps(response_body)}
+
+
+def queue_slot(file_type_config, body, response_body, context=None):
+
+    glue_job_name = file_type_config['glue_job_name']
+
+    # Queued first: if advancing fails, p1 hands the same slot out again and queueing it is a no-op
+    enqueue_glue_slice(glue_job_name, glue_slice(file_type_config, body))
+    update_schd_status(body['file_type'], body['load_date'], body.get('schd_id'), body.get('slot_count'), body.get('catchup_slots') or 1)
+
+    queue = get_glue_queue(glue_job_name)
+    if not glue_batch_due(queue):
+        response_body['STATUS'] = 'QUEUED'
+        response_body['queued_slices'] = len(queue)
+        return {'statusCode': 202, 'body': json.dumps(response_body)}
+
+    result = flush_glue_batch(glue_job_name, context)
+    if result['statusCode'] == 204:
+        # Another invocation took the batch, this slice included
+        response_body['STATUS'] = 'QUEUED'
+        return {'statusCode': 202, 'body': json.dumps(response_body)}
+    response_body.update(json.loads(result['body']))
+    return {'statusCode': result['statusCode'], 'body': json.dumps(response_body)}
+
     
-    logger.info(event)
+def process_slot(body, context=None):
 
-    body = event['responsePayload']['body']
-    file_type = body['file_type']
-    load_date = body['load_date']
-    hour = body['hour']
+    file_type = body.get('file_type')
+    load_date = body.get('load_date')
+    hour = body.get('hour')
+
+    metrics.set_dimensions(file_type=file_type, load_date=load_date, hour=hour)
     
+    response_body = {}
     response_body['file_type'] = file_type
     response_body['load_date'] = load_date
     response_body['hour'] = hour
@@ -198,24 +549,109 @@ def lambda_handler(event, context):
     else:
         
         logger.info("Received signal to proceed!!")
-        
-        # Get the config from DynamoDb.
-        
-        file_type_config = from_dynamodb_to_json(get_dynamo_table_data(file_type, '2999-12-31')[0])
-        
-        # trigger the glue job
-        glue_response = trigger_glue_job(file_type_config, load_date, hour)
-        
-        # Check the status
-        status = glue_status_check(glue_response['JobRunId'],file_type_config['glue_job_name'])
-        
-        # Update the status
-        update_schd_status(file_type, load_date)
-        
-        
-        response_body['STATUS'] = status
+
+        if not IDEMPOTENCY:
+            return run_slot(body, response_body, context)
+
+        key = idempotency_key('p3', body)
+        token, record = claim_execution(key, IDEMPOTENCY_LEASE)
+        if token is None:
+            return cached_response(key, response_body, record)
+
+        body = dict(body, idempotency_key=key, idempotency_token=token)
+        try:
+            result = run_slot(body, response_body, context)
+        except Exception:
+            release_execution(key, token)
+            raise
+
+        # A batched slot is kept from being exported twice by its queue item, so a redelivery only
+        # re-checks whether the batch came due; a single run handed over to the complete path (202)
+        # carries the lease on to it
+        if GLUE_BATCH_SIZE > 1:
+            release_execution(key, token)
+        elif result['statusCode'] == 200:
+            complete_execution(key, token, result)
+        return result
+
+
+def cached_response(key, response_body, record):
+
+    if record.get('execution_status') == 'COMPLETED':
+        logger.info(f"{key} already ran, returning its outcome")
+        return json.loads(record['execution_outcome'])
+
+    logger.info(f"{key} is running in another invocation")
+    response_body['STATUS'] = 'IN_PROGRESS'
+    return {
+        'statusCode': 202,
+        'body': json.dumps(response_body)
+    }
+
+
+def run_slot(body, response_body, context=None):
+
+    file_type = body.get('file_type')
+    load_date = body.get('load_date')
+    hour = body.get('hour')
+
+    # Get the config from DynamoDb.
+    
+    file_type_config = get_file_type_config(file_type, body.get('config_version'))
+
+    if GLUE_BATCH_SIZE > 1:
+        return queue_slot(file_type_config, body, response_body, context)
+    
+    # trigger the glue job
+    glue_response = trigger_glue_job(file_type_config, load_date, hour, body.get('hour_end'))
     
+    # Start path only: the complete path picks the run up from its completion event or a poll
+    if GLUE_COMPLETION_MODE == 'event':
+        return hand_over_glue_run(glue_response['JobRunId'], file_type_config['glue_job_name'], body, response_body, 'STARTED')
+
+    # Check the status
+    status = glue_status_check(glue_response['JobRunId'],file_type_config['glue_job_name'], timeout=wait_timeout(context))
+
+    # Still running at the timeout: the slot is only advanced once the complete path saw the run succeed
+    if status != 'SUCCEEDED':
+        return hand_over_glue_run(glue_response['JobRunId'], file_type_config['glue_job_name'], body, response_body, status)
+    
+    # Update the status
+    update_schd_status(file_type, load_date, body.get('schd_id'), body.get('slot_count'), body.get('catchup_slots') or 1)
+    
+    
+    response_body['STATUS'] = status
+
     return {
         'statusCode': 200,
         'body': json.dumps(response_body)
     }
+
+
+@metrics.timed('p3_handler')
+def lambda_handler(event, context):
+    # TODO implement
+    
+    logger.info(event)
+
+    metrics.set_dimensions()
+
+    # Complete path of the event mode
+    if event.get('source') == 'aws.glue':
+        return handle_glue_event(event)
+    if 'glue_poll' in event:
+        return handle_glue_poll(event['glue_poll'])
+    if 'glue_flush' in event:
+        return flush_glue_batch(event['glue_flush'], context)
+
+    body = event['responsePayload']['body']
+
+    # p2 answers for several file types sharing a slot with one body per slot
+    if body.get('slots'):
+        results = [process_slot(slot_body, context) for slot_body in body['slots']]
+        return {
+            'statusCode': 200 if any(r['statusCode'] in (200, 202) for r in results) else 404,
+            'body': json.dumps({'slots': [json.loads(r['body']) if isinstance(r['body'], str) else r['body'] for r in results]})
+        }
+
+    return process_slot(body, context)
@@ -2,33 +2,43 @@ import json
 import datetime
 from datetime import timezone
 import logging
-import boto3
+import time
 import os
-from boto3.dynamodb.types import TypeDeserializer
+import random
+
+# Shared with main.py and p2 / p3 through the lambdas' layer (lambdas/build_layer.py)
+import metrics
+from aws_clients import get_client
+from config_table import (
+    CONFIG_LOAD_DATE, TABLE_NAME, ScheduleItem, client_error, decode_schedule_item, from_dynamodb_to_json,
+    get_config_table, is_conditional_check_failure
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-response_body = {}
+# Catch-up mode: hand up to this many overdue slots to p2 in one go (1 keeps one slot per run)
+MAX_CATCHUP_SLOTS = int(os.environ.get('max_catchup_slots', 1))
 
-# client for s3
-s3_client = boto3.client('s3')
+# Fan-out mode ({"fan_out": true, "event_datetime": ...}): one trigger schedules every active
+# file_type. Their config rows are found on the config_index_name GSI (hash key load_date, so all
+# the '2999-12-31' rows come back from one query) and their current schedule items with one
+# BatchGetItem through the config rows' active_load_date. With p2_function_name set, p2 is
+# invoked asynchronously once per due file_type; otherwise the due bodies are returned as
+# {"slots": [...]}, which p2 runs as one query DAG.
+CONFIG_INDEX_NAME = os.environ.get('config_index_name', 'load_date-index')
+P2_FUNCTION_NAME = os.environ.get('p2_function_name')
 
-# DynamoDB boto3 handles
-dyn_c2c_config_table_name = os.environ['config_table_name']
-dynamoDB_client = boto3.client('dynamodb')
-dynamodb_resource = boto3.resource('dynamodb')
-c2c_pipeline_config = dynamodb_resource.Table(dyn_c2c_config_table_name)
+# UnprocessedKeys of a BatchGetItem are retried with exponential backoff and full jitter
+BATCH_GET_MAX_ATTEMPTS = int(os.environ.get('batch_get_max_attempts', 8))
+BATCH_GET_BASE_DELAY = 0.05
 
+# Items other stages keep in the config table under their own file_type, never scheduled
+PSEUDO_FILE_TYPES = ('p2_continuation', 'p3_glue_run', 'p3_glue_queue', 'idempotency')
 
 # Util Functions
 addZero = lambda x : '0' + x if len(x) == 1 else x
 
-# Converts Dynmo object to json
-def from_dynamodb_to_json(item):
-    d = TypeDeserializer()
-    return {k: d.deserialize(value=v) for k, v in item.items()}
-
 
 # compares 2 datetime and return true or false. Used to get latest file to process 
 def compare_dates(event_date, schedule_datetime):
@@ -39,84 +49,172 @@ def compare_dates(event_date, schedule_datetime):
     return event_date > new_schedule_datetime
     
     
-# Funciton to get the config from Dynamo table based on file_type and date
-def get_dynamo_table_data(file_type, load_date=None):
-    
-    response = dynamoDB_client.query(
-        TableName=dyn_c2c_config_table_name,
-        KeyConditionExpression='file_type = :f and load_date = :sd',
-        FilterExpression = 'processing_flag = :pf',
+# The static config row (CONFIG_LOAD_DATE) shares the file_type partition, every schedule item sorts below it.
+# Newest schedule item of a file_type: load_date is the sort key and ISO dates sort
+# chronologically, so one descending Limit=1 query finds it however much history there is.
+# p1 only starts a new day once the previous one is done, so this item is also the only one
+# that can still have processing_flag 'Y'.
+@metrics.timed('dynamodb_read')
+def get_latest_schedule_item(file_type):
+
+    response = get_client('dynamodb').query(
+        TableName=TABLE_NAME,
+        KeyConditionExpression='file_type = :f and load_date < :cfg',
         ExpressionAttributeValues={
             ':f': {'S': file_type},
-            ':sd' : {'S': load_date},
-            ':pf' : {'S': 'Y'}
-        }
+            ':cfg' : {'S': CONFIG_LOAD_DATE}
+        },
+        ScanIndexForward=False,
+        Limit=1
     )
-    
-    return response['Items']
 
+    items = response['Items']
+    return decode_schedule_item(items[0]) if items else None
 
-def get_processing_data(file_type,pf='Y'):
 
-    response = dynamoDB_client.query(
-        TableName=dyn_c2c_config_table_name,
-        KeyConditionExpression='file_type = :f',
-        FilterExpression = 'processing_flag = :pf',
-        ProjectionExpression = 'load_date',
-        ExpressionAttributeValues={
-            ':f': {'S': file_type},
-            ':pf' : {'S': pf}
-        }
-    )
-    
-    return response
+# Schedule items are stored compactly: slot_count slots a day and next_slot, the schd_id of the
+# first queued one. Slot times are derived from the schd_id instead of being stored.
+MIN_LIST = ['15:00', '30:00', '45:00', '59:59']
 
 
+def get_slot_count(frequency):
+    return 24 if frequency == 'Hourly' else 96
+
+
+def get_slot_time(schd_id, slot_count):
+    if slot_count == 24:
+        return addZero(str(schd_id - 1)) + ':59:00'
+    return addZero(str((schd_id - 1) // 4)) + ':' + MIN_LIST[(schd_id - 1) % 4]
 
-# Creates all 96 schedule for the day
-def get_schd_day_list(frequency):
-    schd_list = []
-    id = 0
-    if frequency != None and frequency == 'Hourly':
-        for hour in range(0,24):
-            hr = addZero(str(hour))
-            time = hr + ':59:00'
-            id += 1
-            dict_name = dict()
-            dict_name['schd_id'] = int(id)
-            dict_name['schd_time'] = time
-            dict_name['status'] = 'q'
-            schd_list.append(dict_name)
-    else:
-        for hour in range(0,24):
-            min_list = ['15:00', '30:00', '45:00', '59:59']
-            for i in min_list:
-                hr = addZero(str(hour))
-                time = hr + ':' + i
-                id += 1
-                dict_name = dict()
-                dict_name['schd_id'] = int(id)
-                dict_name['schd_time'] = time
-                dict_name['status'] = 'q'
-                schd_list.append(dict_name)
-    return schd_list
+
+# Next queued slot of a schedule item, legacy schd_day items come decoded to the same record
+def get_next_schedule(file_config):
+
+    schd_id = min(file_config.next_slot, file_config.slot_count)
+    return {
+        'schd_id': schd_id,
+        'schd_time': get_slot_time(schd_id, file_config.slot_count),
+        'status': 'q' if file_config.next_slot <= file_config.slot_count else 's',
+        'slot_count': file_config.slot_count
+    }
+
+
+def get_slot_datetime(load_date, schd_id, slot_count):
+    return datetime.datetime.strptime(load_date + 'T' + get_slot_time(schd_id, slot_count) + 'Z', "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+
+# Number of queued slots from schd_id on that are already behind event_datetime (at most max_slots)
+def get_due_slots(load_date, schd_id, slot_count, event_datetime, max_slots=MAX_CATCHUP_SLOTS):
+    due = 0
+    for slot_id in range(schd_id, min(slot_count, schd_id + max_slots - 1) + 1):
+        if event_datetime <= get_slot_datetime(load_date, slot_id, slot_count):
+            break
+        due += 1
+    return due
 
 
 # Use DynamoDB boto3's put_item API to add the schedule to the config table
+@metrics.timed('dynamodb_write')
 def put_item_dynamodb(file_type, load_date, frequency=None):
     
     dynamoDb_put_item = {
         "file_type" : file_type,
         "load_date" : load_date,
         "processing_flag" : "Y",
-        "schd_day" : get_schd_day_list(frequency)
+        "frequency" : frequency or "15min",
+        "slot_count" : get_slot_count(frequency),
+        "next_slot" : 1
     }
     
-    c2c_pipeline_config.put_item(Item = dynamoDb_put_item)
+    # Only ever creates the day: a duplicate or late invocation must not reset a next_slot
+    # that p2 / p3 have advanced since
+    try:
+        get_config_table().put_item(Item = dynamoDb_put_item, ConditionExpression='attribute_not_exists(load_date)')
+        item = ScheduleItem(file_type, load_date, 'Y', dynamoDb_put_item['frequency'], dynamoDb_put_item['slot_count'], 1, False)
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.info(f"{file_type}/{load_date} is already scheduled, using the stored item")
+        item = get_schedule_item(file_type, load_date)
+
+    set_active_load_date(file_type, load_date)
 
-    return dynamoDb_put_item
+    return item
+
+
+@metrics.timed('dynamodb_read')
+def get_schedule_item(file_type, load_date):
+    response = get_client('dynamodb').get_item(
+        TableName=TABLE_NAME,
+        Key={'file_type': {'S': file_type}, 'load_date': {'S': load_date}},
+        ConsistentRead=True
+    )
+    return decode_schedule_item(response['Item'])
     
 
+# Points the file_type's config row at its newest schedule item, for the fan-out BatchGetItem
+@metrics.timed('dynamodb_write')
+def set_active_load_date(file_type, load_date):
+    try:
+        get_config_table().update_item(
+            Key={'file_type': file_type, 'load_date': CONFIG_LOAD_DATE},
+            UpdateExpression='SET active_load_date = :d',
+            ConditionExpression='attribute_exists(file_type)',
+            ExpressionAttributeValues={':d': load_date}
+        )
+    except client_error() as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.info(f"No config row for file_type: {file_type}, nothing to point at {load_date}")
+
+
+# Config rows of every file_type to schedule, from one (paginated) query on the GSI
+@metrics.timed('dynamodb_read')
+def get_active_file_type_configs():
+
+    configs = []
+    query = {
+        'TableName': TABLE_NAME,
+        'IndexName': CONFIG_INDEX_NAME,
+        'KeyConditionExpression': 'load_date = :cfg',
+        'ExpressionAttributeValues': {':cfg': {'S': CONFIG_LOAD_DATE}}
+    }
+    while True:
+        response = get_client('dynamodb').query(**query)
+        configs.extend(from_dynamodb_to_json(item) for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return [c for c in configs if c['file_type'] not in PSEUDO_FILE_TYPES and c.get('schedule_active', True)]
+
+
+# {file_type: ScheduleItem} for the given (file_type, load_date) pairs, 100 keys per BatchGetItem
+@metrics.timed('dynamodb_read')
+def batch_get_schedule_items(keys):
+
+    items = {}
+    keys = [{'file_type': {'S': file_type}, 'load_date': {'S': load_date}} for file_type, load_date in keys]
+
+    for i in range(0, len(keys), 100):
+        request = {TABLE_NAME: {'Keys': keys[i:i + 100]}}
+        for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(random.uniform(0, BATCH_GET_BASE_DELAY * 2 ** attempt))
+            response = get_client('dynamodb').batch_get_item(RequestItems=request)
+            for typed in response['Responses'].get(TABLE_NAME, []):
+                item = decode_schedule_item(typed)
+                items[item.file_type] = item
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+        else:
+            raise Exception(f"BatchGetItem left {len(request[TABLE_NAME]['Keys'])} keys unprocessed "
+                            f"after {BATCH_GET_MAX_ATTEMPTS} attempts")
+
+    return items
+
+
 # returns a response body
 def get_resp_body(**kwargs):
     resp_body = {}
@@ -125,102 +223,172 @@ def get_resp_body(**kwargs):
     return resp_body
 
 
-def lambda_handler(event, context):
-    # TODO implement
-    
-    try:
-        file_type = json.loads(event)["file_type"]
-        schd_start_date = str(json.loads(event)["schd_start_datetime"]).split("T")[0]
-        event_date = str(json.loads(event)["event_datetime"]).split("T")[0]
-        event_datetime = str(json.loads(event)["event_datetime"])
-        frequency = json.loads(event).get("frequency",None)
-    except TypeError as t:
-        file_type = event["file_type"]
-        schd_start_date = str(event["schd_start_datetime"]).split("T")[0]
-        event_date = str(event["event_datetime"]).split("T")[0]
-        event_datetime = str(event["event_datetime"])
-        frequency = event.get("frequency",None)
-    
-        
-    logger_info = {
-        "file_type" : file_type,
-        "schd_start_date" : schd_start_date,
-        "event_date" : event_date,
-        "event_datetime" : event_datetime,
-        "frequency" : frequency
-    }
-    
-    logger.info(f"{json.dumps(logger_info)}")
-    
+# Works out the slot of one file_type from its newest schedule item (None before its first day),
+# starting the next day when the newest one is done, and returns the body for p2
+def schedule_file_type(file_type, latest_item, schd_start_date, event_datetime, frequency=None):
+
+    response_body = {}
     response_body['file_type'] = file_type
     
-    # Check if its the latest schedule to be processed
-    dynamo_resp = get_processing_data(file_type,pf='Y')
-    
-    logger.info(f"dynamo_resp: {dynamo_resp}")
+    logger.info(f"latest_item: {latest_item}")
     
-    # Initialize file_config
-    file_config = {}
-    
-    if dynamo_resp.get('Count') == 0:
+    if latest_item is None:
+        logger.info(f"Creating first schedule for file_type: {file_type}")
+        file_config = put_item_dynamodb(file_type,schd_start_date, frequency=frequency)
+    elif latest_item.processing_flag == 'N':
         logger.info("Getting the latest date to process...")
-        
-        pf_N_resp = get_processing_data(file_type,pf='N')
-        if pf_N_resp.get('Items'):
-            items = pf_N_resp.get('Items')
-            load_date_deserde = [from_dynamodb_to_json(x) for x in items]
-            logger.info(f"load_date_deserde : {load_date_deserde}")
-            # Get the previous process date that was processed
-            last_process_date = sorted(load_date_deserde, key = lambda i : datetime.datetime.strptime(i['load_date'], '%Y-%m-%d'),reverse=True)[0]['load_date']
-            # Add one to the previous process date
-            latest_date = datetime.datetime.strptime(last_process_date, '%Y-%m-%d') + datetime.timedelta(days=1)
-            logger.info(f"The latest processing date: {str(latest_date.date())}")
-            file_config = put_item_dynamodb(file_type,str(latest_date.date()), frequency=frequency)
-        else:
-            logger.info(f"Creating first schedule for file_type: {file_type}")
-            file_config = put_item_dynamodb(file_type,schd_start_date, frequency=frequency)
-    elif dynamo_resp.get('Count') == 1:
-        processing_date = from_dynamodb_to_json(dynamo_resp.get('Items')[0]).get('load_date')
-        logger.info(f"Get the latest schedule from processing_date: {processing_date}")
-        file_config = from_dynamodb_to_json(get_dynamo_table_data(file_type, load_date=processing_date)[0])
+        # Add one to the previous process date
+        latest_date = datetime.datetime.strptime(latest_item.load_date, '%Y-%m-%d') + datetime.timedelta(days=1)
+        logger.info(f"The latest processing date: {str(latest_date.date())}")
+        file_config = put_item_dynamodb(file_type,str(latest_date.date()), frequency=frequency)
+    else:
+        logger.info(f"Get the latest schedule from processing_date: {latest_item.load_date}")
+        file_config = latest_item
         
     
-    # Get the latest schedule from the schd_day in the config
-    logger.info(f"schd_day: {file_config['schd_day']}")
-    schd_day = file_config['schd_day']
-    # Get the Latest Schedule from the item with Status queued
-    schedule = sorted(schd_day, key = lambda items: items['schd_id'] if items['status']=='q' else 999999)[0]
+    # Get the Latest Schedule, the first slot with Status queued
+    schedule = get_next_schedule(file_config)
     logger.info(f"Latest Schdule: {schedule}")
             
         
 
     
-    logger.info(f"schdule_datetime: {file_config['load_date']}T{schedule['schd_time']}Z")
-    schdule_datetime = datetime.datetime.strptime(file_config['load_date'] + 'T' + schedule['schd_time'] + 'Z', "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    logger.info(f"schdule_datetime: {file_config.load_date}T{schedule['schd_time']}Z")
+    schdule_datetime = datetime.datetime.strptime(file_config.load_date + 'T' + schedule['schd_time'] + 'Z', "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
     
     logger.info(f"event_datetime: {event_datetime}")
     event_datetime = datetime.datetime.strptime(event_datetime, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
     
     compare_datetime = lambda x,y : x > y.replace(tzinfo=y.tzinfo).astimezone(tz=x.tzinfo)
     hour = addZero(str(schdule_datetime.hour))
+
+    metrics.update_dimensions(load_date=file_config.load_date, hour=hour)
+
+    # p2 / p3 advance exactly this slot once it is processed
+    response_body['schd_id'] = schedule['schd_id']
+    response_body['slot_count'] = schedule['slot_count']
     
     if compare_datetime(event_datetime, schdule_datetime):
         # Get the filenames from the work bucket
         response_body['query_flag'] = 'Y'
         response_body['hour'] = hour
-        response_body['load_date'] = file_config['load_date']
+        response_body['load_date'] = file_config.load_date
+
+        # After an outage several slots can be overdue, p2 can then process all of them in one run
+        catchup_slots = get_due_slots(file_config.load_date, schedule['schd_id'], schedule['slot_count'], event_datetime)
+        last_slot_datetime = get_slot_datetime(file_config.load_date, schedule['schd_id'] + catchup_slots - 1, schedule['slot_count'])
+        response_body['catchup_slots'] = catchup_slots
+        response_body['hour_end'] = addZero(str(last_slot_datetime.hour))
+        if catchup_slots > 1:
+            logger.info(f"Catching up on {catchup_slots} slots, hours {hour} to {response_body['hour_end']}")
     else:
         logger.info("Schedule is running ahead")
         logger.info("Process nothing")
         response_body['query_flag'] = 'N'
         response_body['hour'] = hour
-        response_body['load_date'] = file_config['load_date']
+        response_body['load_date'] = file_config.load_date
+        response_body['catchup_slots'] = 0
+        response_body['hour_end'] = hour
 
     
     logger.info(f"response_body: {response_body}")
     
     
+    return response_body
+
+
+def handle_fan_out(event):
+
+    event_datetime = str(event["event_datetime"])
+    file_type_configs = get_active_file_type_configs()
+    logger.info(f"Scheduling file_types: {[c['file_type'] for c in file_type_configs]}")
+
+    latest_items = batch_get_schedule_items(
+        [(c['file_type'], c['active_load_date']) for c in file_type_configs if c.get('active_load_date')])
+
+    bodies = []
+    for file_type_config in file_type_configs:
+        file_type = file_type_config['file_type']
+        metrics.set_dimensions(file_type=file_type)
+
+        latest_item = latest_items.get(file_type)
+        # No pointer yet: find the newest item the single file_type way, once
+        if latest_item is None:
+            latest_item = get_latest_schedule_item(file_type)
+            if latest_item is not None:
+                set_active_load_date(file_type, latest_item.load_date)
+
+        schd_start_date = str(file_type_config.get('schd_start_datetime') or event.get("schd_start_datetime") or event_datetime).split("T")[0]
+        body = schedule_file_type(file_type, latest_item, schd_start_date, event_datetime,
+                                  file_type_config.get('frequency') or event.get("frequency"))
+        # p2 and p3 check their cached config row against the version read here
+        if file_type_config.get('config_version') is not None:
+            body['config_version'] = str(file_type_config['config_version'])
+        bodies.append(body)
+
+    due = [body for body in bodies if body['query_flag'] == 'Y']
+    logger.info(f"{len(due)} of {len(bodies)} file_types are due")
+
+    if P2_FUNCTION_NAME:
+        for body in due:
+            invoke_p2(body)
+        # Nothing left for a p2 chained on this function's destination
+        return {
+            'statusCode': 200,
+            'body': {'slots': [], 'query_flag': 'N', 'invoked': [body['file_type'] for body in due]}
+        }
+
+    return {
+        'statusCode': 200,
+        'body': {'slots': due, 'query_flag': 'Y' if due else 'N'}
+    }
+
+
+# Same payload shape as the Lambda destination p2 is normally invoked with
+@metrics.timed('lambda_invoke')
+def invoke_p2(body):
+    get_client('lambda').invoke(
+        FunctionName=P2_FUNCTION_NAME,
+        InvocationType='Event',
+        Payload=json.dumps({'responsePayload': {'statusCode': 200, 'body': body}}).encode('utf-8')
+    )
+
+
+@metrics.timed('p1_handler')
+def lambda_handler(event, context):
+    # TODO implement
+    
+    # The event comes either as a JSON string or as an already decoded dict, decode it only once
+    if isinstance(event, (str, bytes)):
+        event = json.loads(event)
+
+    if event.get("fan_out"):
+        metrics.set_dimensions()
+        return handle_fan_out(event)
+
+    file_type = event["file_type"]
+    schd_start_date = str(event["schd_start_datetime"]).split("T")[0]
+    event_datetime = str(event["event_datetime"])
+    event_date = event_datetime.split("T")[0]
+    frequency = event.get("frequency",None)
+
+    metrics.set_dimensions(file_type=file_type)
+
+        
+    logger_info = {
+        "file_type" : file_type,
+        "schd_start_date" : schd_start_date,
+        "event_date" : event_date,
+        "event_datetime" : event_datetime,
+        "frequency" : frequency
+    }
+    
+    logger.info(f"{json.dumps(logger_info)}")
+    
+    # Check if its the latest schedule to be processed
+    latest_item = get_latest_schedule_item(file_type)
+
     return {
         'statusCode': 200,
-        'body': response_body
+        'body': schedule_file_type(file_type, latest_item, schd_start_date, event_datetime, frequency)
     }
@@ -1,13 +1,20 @@
-import requests
 import os
 import json
-from config import RESOURCE_PATH
 from requests.auth import AuthBase
 import logging
-import boto3.session
+import athena_poller
+import aws_clients
+import metrics
+import output_formats
+from utility_api import UtilityApiClient
 import sys
+import io
 import uuid
-import time
+import itertools
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from checkpoint import CheckpointStore, newer_than, parse_mark
 
 
 logger = logging.getLogger(__name__)
@@ -28,44 +35,287 @@ config = {
     "SECRET_KEY": "The Secret key",
     "BUCKET_NAME": 'athena-query-result-720863956745',
     "KEY": 'userdata/power_analytics/{file_type}/user_name={user_name}',
-    "API_TOKEN": "The token number"
+    "API_TOKEN": "The token number",
+    "MAX_WORKERS": 8,
+    # Upper bound on UtilityAPI requests in flight across every job of the process
+    "API_CONCURRENCY": 8,
+    # Shared UtilityAPI rate limit, requests per second
+    "API_RATE": 10,
+    "API_MAX_RETRIES": 5,
+    # How responses become NDJSON lines:
+    #   'document' - one line per response, parsed and re-serialized (needs the whole document in memory)
+    #   'stream'   - one line per record, decoded incrementally from the socket (needs ijson)
+    #   'raw'      - one line per response, the body bytes passed through without parsing them (needs ijson)
+    "DECODE_MODE": 'document',
+    # S3 needs every part except the last to be at least 5 MiB
+    "PART_SIZE": 8 * 1024 * 1024,
+    # High-water marks for the incremental mode
+    "CHECKPOINT_PATH": 'checkpoints.json',
+    # One of output_formats.FORMATS: ndjson, ndjson.gz, ndjson.zst, parquet
+    "OUTPUT_FORMAT": 'ndjson',
+    "ATHENA_DATABASE": 'sampledb',
+    "ATHENA_TABLE": '{file_type}_table',
+    # Total seconds to wait on a query before giving up on it
+    "ATHENA_TIMEOUT": 300,
+    "ATHENA_OUTPUT_LOCATION": 's3://athena-query-result-720863956745/query_result/',
+    # 'ddl' registers user_name partitions with ALTER TABLE, 'projection' relies on partition projection
+    "PARTITION_MODE": 'ddl',
+    "PARTITION_STATE_PATH": 'registered_partitions.json',
+    # EMF metric lines (see metrics.py) go to stderr, so stdout keeps the run's own output
+    "METRICS": True
 }
 
-my_session = boto3.session.Session(aws_access_key_id=f"{config['ACCESS_KEY']}",aws_secret_access_key=f"{config['SECRET_KEY']}")
+metrics.configure(enabled=config['METRICS'], stream=sys.stderr)
+
+# boto3 session and clients are built lazily, once per process, by aws_clients
+aws_clients.configure(aws_access_key_id=f"{config['ACCESS_KEY']}",aws_secret_access_key=f"{config['SECRET_KEY']}")
+
+# One rate-limited, retrying client (and keep-alive pool) shared by all the meter fetches
+api_client = UtilityApiClient(
+    config['API_TOKEN'],
+    rate=config['API_RATE'],
+    max_concurrency=config['API_CONCURRENCY'],
+    max_retries=config['API_MAX_RETRIES']
+)
+
+
+# Sizes the connection pool and the process-wide cap on requests in flight
+def set_api_concurrency(api_concurrency):
+    config['API_CONCURRENCY'] = api_concurrency
+    api_client.set_concurrency(api_concurrency)
 
 
 def write_file_to_s3(put_object, user_name, file_type):
 
-    ACCESS_KEY = config['ACCESS_KEY']
-    SECRET_KEY = config['SECRET_KEY']
     BUCKET_NAME = config['BUCKET_NAME']
     KEY = config['KEY'].format(file_type=file_type, user_name=user_name) + f'/{file_type}_{uuid.uuid1()}'
 
-    my_session = boto3.session.Session(aws_access_key_id=f"{ACCESS_KEY}",aws_secret_access_key=f"{SECRET_KEY}")
-    s3_client = my_session.client('s3')
+    s3_client = aws_clients.get_client('s3')
 
-    response = s3_client.put_object(ACL='bucket-owner-full-control',Body=put_object, Bucket=BUCKET_NAME, Key=KEY)
+    with metrics.timer('s3_put', file_type=file_type):
+        response = s3_client.put_object(ACL='bucket-owner-full-control',Body=put_object, Bucket=BUCKET_NAME, Key=KEY)
     return response
 
 
-def make_api_call(utility, meters=[], file_type='bills'):
+# Streams NDJSON lines to S3 as a multipart upload in the chosen output format,
+# shipping a part as soon as the buffer fills. s3_slots (a semaphore) caps the S3 calls in
+# flight across uploads; it is only held around each call, not while the lines are produced.
+def write_stream_to_s3(lines, user_name, file_type, part_size=None, skip_empty=False, output_format=None, s3_slots=None):
+
+    # With skip_empty nothing is written when the stream has no data at all
+    if skip_empty:
+        lines = iter(lines)
+        first = next((line for line in lines if line), None)
+        if first is None:
+            logger.info(f"No new {file_type} for {user_name}, skipping the upload")
+            return None
+        lines = itertools.chain([first], lines)
+
+    part_size = part_size or config['PART_SIZE']
+    output_format = output_format or config['OUTPUT_FORMAT']
+    BUCKET_NAME = config['BUCKET_NAME']
+    KEY = config['KEY'].format(file_type=file_type, user_name=user_name) + f'/{file_type}_{uuid.uuid1()}' + output_formats.extension(output_format)
+
+    s3_client = aws_clients.get_client('s3')
+    s3_slot = s3_slots or contextlib.nullcontext()
+
+    with s3_slot:
+        upload = s3_client.create_multipart_upload(ACL='bucket-owner-full-control', Bucket=BUCKET_NAME, Key=KEY)
+    upload_id = upload['UploadId']
+    parts = []
+    buffer = bytearray()
+
+    def ship(body):
+        part_number = len(parts) + 1
+        with s3_slot, metrics.timer('s3_put', file_type=file_type):
+            part = s3_client.upload_part(Body=bytes(body), Bucket=BUCKET_NAME, Key=KEY, PartNumber=part_number, UploadId=upload_id)
+        parts.append({'ETag': part['ETag'], 'PartNumber': part_number})
+
+    try:
+        for chunk in output_formats.encode_stream(lines, output_format, file_type):
+            buffer += chunk
+            if len(buffer) >= part_size:
+                ship(buffer)
+                buffer.clear()
+
+        # The last part may be smaller than part_size, and an empty object still needs one part
+        if buffer or not parts:
+            ship(buffer)
+
+        with s3_slot:
+            return s3_client.complete_multipart_upload(Bucket=BUCKET_NAME, Key=KEY, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+    except Exception:
+        logger.info(f"Aborting multipart upload {upload_id} for {KEY}")
+        s3_client.abort_multipart_upload(Bucket=BUCKET_NAME, Key=KEY, UploadId=upload_id)
+        raise
+
+
+# Fetches a single meter and returns its NDJSON line, or "" when there is nothing to keep.
+# In stream mode it returns a StreamedRecords that decodes the response as it is consumed.
+# With slot_held the caller took an API slot for the fetch; it is handed back here, or by the
+# StreamedRecords once its response is closed.
+@metrics.timed('http_fetch', 'file_type')
+def fetch_meter(utility, meter, file_type='bills', checkpoints=None, decode_mode=None, slot_held=False):
+
+    if checkpoints is not None:
+        return fetch_meter_since(utility, meter, file_type, checkpoints)
+
+    decode_mode = decode_mode or config['DECODE_MODE']
+    try:
+        response = api_client.get(api_client.url(file_type), params={'meters': meter, 'utility': utility},
+            stream=decode_mode == 'stream', slot_held=slot_held)
+    except Exception:
+        if slot_held:
+            api_client.release_slot()
+        raise
+
+    if decode_mode == 'stream' and response.status_code != 404:
+        return StreamedRecords(response, file_type, slot_held)
+    if slot_held:
+        api_client.release_slot()
+
+    if response.status_code != 404:
+        try:
+            if decode_mode == 'raw':
+                return raw_line(response.content, file_type)
+            payload = response.json()
+            if payload[f'{file_type}']:
+                return json.dumps(payload) + "\n"
+        except KeyError as e:
+            print(e)
+    else:
+        response.close()
+
+    return ""
+
+
+# Decodes the file_type array straight off the socket and yields one NDJSON line per record,
+# so neither a large intervals response nor its NDJSON is ever held in memory as a whole.
+# close() gives the connection (and the API slot, if one is held) back whether or not the
+# lines were read.
+class StreamedRecords:
+
+    def __init__(self, response, file_type, slot_held=False):
+        self.response = response
+        self.file_type = file_type
+        self.slot_held = slot_held
+
+    def __iter__(self):
+
+        import ijson
+
+        self.response.raw.decode_content = True
+        records = 0
+        try:
+            for record in ijson.items(self.response.raw, f'{self.file_type}.item', use_float=True):
+                records += 1
+                yield json.dumps(record) + "\n"
+        finally:
+            self.close()
 
-    api_token = config['API_TOKEN']
+        if not records:
+            logger.info(f"No {self.file_type} in the response from {self.response.url}")
 
-    api_value = ""
+    def close(self):
+        self.response.close()
+        if self.slot_held:
+            self.slot_held = False
+            api_client.release_slot()
 
-    for meter in meters:
-        response = requests.get(f'https://utilityapi.com/api/v2/{file_type}?meters={meter}&utility={utility}', 
-            headers={'Authorization': f'Bearer {api_token}'})
-            
-        if response.status_code != 404:
-            try:
-                if response.json()[f'{file_type}']:
-                    api_value +=  json.dumps(response.json()) + "\n"
-            except KeyError as e:
-                print(e)
-    
-    return api_value
+
+# Passes the response body through as a single NDJSON line without parsing or re-serializing it.
+# Whether the file_type array is empty is read incrementally, up to its first record only.
+# Newlines can only be whitespace between JSON tokens, so they can be dropped safely.
+def raw_line(body, file_type):
+
+    import ijson
+
+    missing = object()
+    if next(ijson.items(io.BytesIO(body), f'{file_type}.item'), missing) is missing:
+        return ""
+    return body.replace(b"\r", b"").replace(b"\n", b"").decode('utf-8') + "\n"
+
+
+# Incremental fetch: asks only for records after the stored high-water mark and follows
+# the "next" links until a page brings nothing newer. The new mark is staged on the store.
+def fetch_meter_since(utility, meter, file_type, checkpoints):
+
+    mark = checkpoints.get(utility, meter, file_type)
+    url = api_client.url(file_type)
+    params = {'meters': meter, 'utility': utility}
+    if mark:
+        params['start'] = mark
+
+    records = []
+    newest = mark
+
+    while url:
+        response = api_client.get(url, params=params)
+        if response.status_code == 404:
+            break
+        try:
+            payload = response.json()
+            page, page_newest = newer_than(payload[f'{file_type}'], file_type, mark)
+        except KeyError as e:
+            print(e)
+            break
+
+        if not page:
+            break
+        records.extend(page)
+        if newest is None or parse_mark(page_newest) > parse_mark(newest):
+            newest = page_newest
+        # The next link already carries the query string
+        url, params = payload.get('next'), None
+
+    if not records:
+        return ""
+
+    checkpoints.stage(utility, meter, file_type, newest)
+    return json.dumps({f'{file_type}': records}) + "\n"
+
+
+# A meter's result is one NDJSON line, or in stream mode an iterator of them
+def meter_lines(result):
+    return [result] if isinstance(result, str) else result
+
+
+# Yields the NDJSON lines of every meter, in meter order, keeping at most 2 * max_workers fetches in flight.
+# In stream mode a fetched response holds its connection until its body has been read, so it holds
+# its API slot that long as well, which keeps the streams open across every job of the process
+# within API_CONCURRENCY. Slots are taken here, in meter order: while none is free the oldest
+# response is read to give its slot back, and the wait only blocks with nothing in flight, so jobs
+# never wait on each other's unread responses.
+def iter_api_call(utility, meters=[], file_type='bills', max_workers=None, checkpoints=None):
+
+    max_workers = max_workers or config['MAX_WORKERS']
+    hold_slots = config['DECODE_MODE'] == 'stream' and checkpoints is None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        try:
+            for meter in meters:
+                if hold_slots:
+                    while in_flight and not api_client.acquire_slot(blocking=False):
+                        yield from meter_lines(in_flight.popleft().result())
+                    if not in_flight:
+                        api_client.acquire_slot()
+                in_flight.append(executor.submit(fetch_meter, utility, meter, file_type, checkpoints, slot_held=hold_slots))
+                if len(in_flight) >= 2 * max_workers:
+                    yield from meter_lines(in_flight.popleft().result())
+            while in_flight:
+                yield from meter_lines(in_flight.popleft().result())
+        finally:
+            # Left early (the upload failed): the responses not read yet still hold their slots
+            for future in in_flight:
+                if future.exception() is None and isinstance(future.result(), StreamedRecords):
+                    future.result().close()
+
+
+def make_api_call(utility, meters=[], file_type='bills', max_workers=None):
+
+    return "".join(iter_api_call(utility, meters, file_type=file_type, max_workers=max_workers))
 
 
 def athena_query_runner(database, table_name, user_name):
@@ -75,49 +325,41 @@ def athena_query_runner(database, table_name, user_name):
     logger.info("Submitting the query!!")
     logger.info(f"Query: {query} \nDatabase: {database}")
 
-    athena_client = my_session.client('athena',region_name = 'us-east-1')
+    athena_client = aws_clients.get_client('athena', region_name='us-east-1')
 
     # Inner function to check the status of the query.
     def status_check(query_execution_id):
-    
-        RETRY_COUNT = 5
-        SLEEP_TIME = 20
-    
-        while(RETRY_COUNT > 0):
-            logger.info(f"RETRY_COUNT: {RETRY_COUNT}")
-            logger.info(f"Sleeping for {str(SLEEP_TIME)} secs before checking the status!!")
-            time.sleep(SLEEP_TIME)
-            logger.info("Checking the status now!!")
-        
-            # Get query_execution_status
-            query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-            query_execution_status = query_status['QueryExecution']['Status']['State']
-            query_status_reason = query_status['QueryExecution']['Status'].get('StateChangeReason', 'No StateChangeReason')
-        
-            if (query_execution_status == 'QUEUED' or query_execution_status == 'RUNNING'):
-                # Increment the retry count
-                RETRY_COUNT -= 1
-            elif query_execution_status == 'SUCCEEDED':
-                logger.info("The Query Succeeded")
-                return query_execution_status
-            elif query_execution_status == 'FAILED':
-                logger.info(f"query_execution_id - {query_execution_id} Failed!! \nReason: {query_status_reason}")
-                return "FAILED"
-            else:
-                logger.info("Did not found a valid status..")
-                return "INVALID"
-    
+
+        with metrics.timer('athena_wait'):
+            execution = athena_poller.wait_for_query(athena_client, query_execution_id, timeout=config['ATHENA_TIMEOUT'])
+        query_execution_status = athena_poller.state_of(execution)
+        query_status_reason = execution['Status'].get('StateChangeReason', 'No StateChangeReason') if execution else 'No StateChangeReason'
+
+        if query_execution_status == 'SUCCEEDED':
+            logger.info("The Query Succeeded")
+            return query_execution_status
+        elif query_execution_status == 'FAILED':
+            logger.info(f"query_execution_id - {query_execution_id} Failed!! \nReason: {query_status_reason}")
+            return "FAILED"
+        elif query_execution_status in ('QUEUED', 'RUNNING'):
+            logger.info(f"query_execution_id - {query_execution_id} still {query_execution_status} after {config['ATHENA_TIMEOUT']}s")
+            return "TIMEOUT"
+        else:
+            logger.info("Did not found a valid status..")
+            return "INVALID"
+
 
     # Execution
-    response = athena_client.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={
-                'Database': database
-            },
-            ResultConfiguration={
-                'OutputLocation': 's3://athena-query-result-720863956745/query_result/'
-            }
-        )
+    with metrics.timer('athena_submit'):
+        response = athena_client.start_query_execution(
+                QueryString=query,
+                QueryExecutionContext={
+                    'Database': database
+                },
+                ResultConfiguration={
+                    'OutputLocation': config['ATHENA_OUTPUT_LOCATION']
+                }
+            )
     # print(response['QueryExecutionId'])
     return status_check(response['QueryExecutionId'])
 
@@ -126,11 +368,18 @@ if __name__ == "__main__":
 
     file_types = ['bills', 'intervals']
 
+    # Pass --incremental to only fetch what is newer than the last successful run
+    checkpoints = CheckpointStore(config['CHECKPOINT_PATH']) if '--incremental' in sys.argv else None
+
     for file_type in file_types:
-        # Make Api call to get the object
-        put_object = make_api_call("SCE", ["782002","782001","782003","778134"], file_type=file_type)
+        # Make Api call to get the records
+        lines = iter_api_call("SCE", ["782002","782001","782003","778134"], file_type=file_type, checkpoints=checkpoints)
+
+        # Stream them to the s3 bucket
+        print(write_stream_to_s3(lines, 'test@test.com', file_type, skip_empty=checkpoints is not None))
 
-        # Write file to the s3 bucket
-        print(write_file_to_s3(put_object, 'test@test.com', file_type))
+        # Only move the high-water marks once the data is safely in s3
+        if checkpoints is not None:
+            checkpoints.commit()
 
         print(athena_query_runner('sampledb', 'bills_table', 'test@test.com'))
@@ -0,0 +1,164 @@
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Structured metrics as CloudWatch embedded metric format (EMF) JSON lines: one line per
+# measurement, with the file_type / load_date / hour dimensions of whatever is being processed.
+#
+#   with metrics.timer('s3_put', file_type='bills'):
+#       ...
+#
+#   @metrics.timed('http_fetch', 'file_type')     # the file_type argument becomes a dimension
+#   def fetch_meter(utility, meter, file_type='bills'):
+#
+# Dimensions set with metrics.dimensions(...) apply to everything measured inside the block on
+# the same thread; keyword dimensions on a timer add to them. A Lambda handler sets the dimensions
+# of its invocation with metrics.set_dimensions(...) instead.
+#
+# main.py imports this module directly; the lambdas get it (with config_table.py) from the layer
+# lambdas/build_layer.py packages. Lines go to stdout unless configured otherwise, which is
+# where Lambda picks EMF up.
+
+NAMESPACE = os.environ.get('metrics_namespace', 'c2c_pipeline')
+DIMENSIONS = ('file_type', 'load_date', 'hour')
+
+_settings = {
+    'enabled': True,
+    # None writes to whatever sys.stdout is at the time
+    'stream': None,
+    'namespace': NAMESPACE,
+    'statistics': os.environ.get('engine_statistics', 'Y') == 'Y'
+}
+_context = threading.local()
+_write_lock = threading.Lock()
+
+
+def configure(enabled=None, stream=None, namespace=None, statistics=None):
+    if enabled is not None:
+        _settings['enabled'] = enabled
+    if stream is not None:
+        _settings['stream'] = stream
+    if namespace is not None:
+        _settings['namespace'] = namespace
+    if statistics is not None:
+        _settings['statistics'] = statistics
+
+
+def current_dimensions():
+    return getattr(_context, 'dimensions', {})
+
+
+@contextmanager
+def dimensions(**values):
+    previous = current_dimensions()
+    _context.dimensions = dict(previous, **values)
+    try:
+        yield
+    finally:
+        _context.dimensions = previous
+
+
+def set_dimensions(**values):
+    _context.dimensions = values
+
+
+def update_dimensions(**values):
+    _context.dimensions = dict(current_dimensions(), **values)
+
+
+def emf_line(name, value, unit, dimension_values):
+
+    dimension_values = {k: str(v) for k, v in dimension_values.items() if v is not None}
+    keys = [k for k in DIMENSIONS if k in dimension_values] + sorted(set(dimension_values) - set(DIMENSIONS))
+
+    # file_type alone as well, so alarms do not have to name a load_date and hour
+    dimension_sets = [keys]
+    if 'file_type' in dimension_values and keys != ['file_type']:
+        dimension_sets.append(['file_type'])
+
+    return json.dumps(dict(dimension_values, **{
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': _settings['namespace'],
+                'Dimensions': dimension_sets,
+                'Metrics': [{'Name': name, 'Unit': unit}]
+            }]
+        },
+        name: value
+    }))
+
+
+def write_line(line):
+    stream = _settings['stream'] or sys.stdout
+    with _write_lock:
+        stream.write(line + '\n')
+        stream.flush()
+
+
+def put_metric(name, value, unit='Milliseconds', **dimension_values):
+
+    if not _settings['enabled']:
+        return
+    write_line(emf_line(name, value, unit, dict(current_dimensions(), **dimension_values)))
+
+
+@contextmanager
+def timer(name, **dimension_values):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        put_metric(name, round((time.perf_counter() - start) * 1000, 3), 'Milliseconds', **dimension_values)
+
+
+# The arguments named in dimension_args are added as dimensions of the measurement
+def timed(name, *dimension_args):
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            dimension_values = {}
+            if dimension_args:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                dimension_values = {arg: bound.arguments.get(arg) for arg in dimension_args}
+            with timer(name, **dimension_values):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Engine statistics (what a query scanned, what a Glue run cost) as one EMF record per execution,
+# labelled with the slot and query it ran for. Only file_type and query are metric dimensions,
+# load_date and hour would make a metric per slot; they stay in the record for Logs Insights and
+# cost_report.py, which picks the records up by their `record` field.
+#
+#   statistics: {name: (value, unit)}
+def statistics_enabled():
+    return _settings['enabled'] and _settings['statistics']
+
+
+def put_statistics(record, labels, statistics, **properties):
+
+    if not statistics_enabled():
+        return
+    labels = {k: str(v) for k, v in labels.items() if v is not None}
+
+    write_line(json.dumps(dict(labels, record=record, **properties, **{
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': _settings['namespace'],
+                'Dimensions': [[k for k in ('file_type', 'query') if k in labels]],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in statistics.items()]
+            }]
+        }
+    }, **{name: value for name, (value, _) in statistics.items()})))
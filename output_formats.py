@@ -0,0 +1,177 @@
+import json
+import zlib
+
+
+# Output formats for the uploaded API data. Each encoder turns the NDJSON lines coming out of
+# iter_api_call into a stream of byte chunks, so the multipart upload keeps memory flat.
+#
+#   ndjson       - one API response per line, as before
+#   ndjson.gz    - the same lines, gzip compressed
+#   ndjson.zst   - the same lines, zstd compressed (needs the zstandard package)
+#   parquet      - bills / intervals flattened into typed rows (needs pyarrow)
+
+FORMATS = ['ndjson', 'ndjson.gz', 'ndjson.zst', 'parquet']
+
+EXTENSIONS = {
+    'ndjson': '',
+    'ndjson.gz': '.gz',
+    'ndjson.zst': '.zst',
+    'parquet': '.parquet'
+}
+
+# Rows per parquet row group, each one is encoded column by column in one go
+ROW_GROUP_SIZE = 50000
+
+
+def extension(output_format):
+    return EXTENSIONS[output_format]
+
+
+def encode_stream(lines, output_format='ndjson', file_type='bills'):
+
+    if output_format == 'ndjson':
+        return (line.encode('utf-8') for line in lines if line)
+    if output_format == 'ndjson.gz':
+        # wbits=31 writes a gzip header, which is what Athena expects for .gz objects
+        return compress_stream(lines, zlib.compressobj(6, zlib.DEFLATED, 31))
+    if output_format == 'ndjson.zst':
+        import zstandard
+        return compress_stream(lines, zstandard.ZstdCompressor(level=3).compressobj())
+    if output_format == 'parquet':
+        return parquet_stream(lines, file_type)
+
+    raise ValueError(f"Unknown output format: {output_format}")
+
+
+def compress_stream(lines, compressor):
+    for line in lines:
+        if line:
+            chunk = compressor.compress(line.encode('utf-8'))
+            if chunk:
+                yield chunk
+    yield compressor.flush()
+
+
+# Typed columns for the flattened rows
+BILLS_COLUMNS = [
+    ('uid', 'string'),
+    ('meter_uid', 'string'),
+    ('utility', 'string'),
+    ('bill_start_date', 'string'),
+    ('bill_end_date', 'string'),
+    ('bill_total_kwh', 'float64'),
+    ('bill_total_cost', 'float64')
+]
+
+INTERVALS_COLUMNS = [
+    ('uid', 'string'),
+    ('meter_uid', 'string'),
+    ('start', 'string'),
+    ('end', 'string'),
+    ('kwh', 'float64')
+]
+
+
+def columns_for(file_type):
+    return INTERVALS_COLUMNS if file_type == 'intervals' else BILLS_COLUMNS
+
+
+# A line is either a whole API response ({"bills": [...]}) or a single record
+def iter_records(lines, file_type):
+    for line in lines:
+        if not line:
+            continue
+        document = json.loads(line)
+        if file_type in document:
+            yield from document[file_type]
+        else:
+            yield document
+
+
+def flatten(record, file_type):
+
+    if file_type == 'intervals':
+        for reading in record.get('readings', []):
+            yield {
+                'uid': record.get('uid'),
+                'meter_uid': record.get('meter_uid'),
+                'start': reading.get('start'),
+                'end': reading.get('end'),
+                'kwh': reading.get('kwh')
+            }
+    else:
+        base = record.get('base', {})
+        yield {
+            'uid': record.get('uid'),
+            'meter_uid': record.get('meter_uid'),
+            'utility': record.get('utility'),
+            'bill_start_date': base.get('bill_start_date'),
+            'bill_end_date': base.get('bill_end_date'),
+            'bill_total_kwh': base.get('bill_total_kwh'),
+            'bill_total_cost': base.get('bill_total_cost')
+        }
+
+
+# pyarrow writes to this sink and we hand out whatever it wrote after every row group
+class _DrainableSink:
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_stream(lines, file_type):
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = columns_for(file_type)
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+
+    sink = _DrainableSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+
+    batch = {name: [] for name, _ in columns}
+    batch_rows = 0
+
+    def write_batch():
+        arrays = [pa.array(batch[name], type=schema.field(name).type) for name, _ in columns]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        for values in batch.values():
+            values.clear()
+
+    for record in iter_records(lines, file_type):
+        for row in flatten(record, file_type):
+            for name, _ in columns:
+                batch[name].append(row[name])
+            batch_rows += 1
+        if batch_rows >= ROW_GROUP_SIZE:
+            write_batch()
+            batch_rows = 0
+            yield sink.drain()
+
+    if batch_rows:
+        write_batch()
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import threading
+
+import athena_poller
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Athena rejects query strings longer than 262144 bytes, keep some headroom
+MAX_QUERY_LENGTH = 250000
+
+
+def quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+# Builds as few "ALTER TABLE ... ADD IF NOT EXISTS PARTITION (...) PARTITION (...)" statements
+# as the query length limit allows
+def add_partition_queries(table_name, user_names, max_length=MAX_QUERY_LENGTH):
+
+    head = f"ALTER TABLE {table_name} ADD IF NOT EXISTS"
+    queries = []
+    query = head
+
+    for user_name in user_names:
+        clause = f" PARTITION (user_name={quote(user_name)})"
+        if query != head and len((query + clause).encode('utf-8')) > max_length:
+            queries.append(query + ";")
+            query = head
+        query += clause
+
+    if query != head:
+        queries.append(query + ";")
+    return queries
+
+
+# With partition projection Athena works the partitions out from the query itself, no DDL per user
+def projection_query(table_name, location_template):
+    return (f"ALTER TABLE {table_name} SET TBLPROPERTIES ("
+            f"'projection.enabled'='true', "
+            f"'projection.user_name.type'='injected', "
+            f"'storage.location.template'={quote(location_template)});")
+
+
+# Collects the user_name partitions that need registering and adds them in bulk.
+# Partitions registered before (in this process or, with state_path, in an earlier run) are skipped.
+# At most max_concurrency queries are in flight at a time, so a large backfill stays under
+# Athena's concurrent query limit.
+class PartitionRegistry:
+
+    def __init__(self, athena_client, database, output_location, state_path=None, timeout=300, max_concurrency=2):
+        self.athena_client = athena_client
+        self.database = database
+        self.output_location = output_location
+        self.state_path = state_path
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.registered = {}
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as f:
+                self.registered = {table: set(users) for table, users in json.load(f).items()}
+
+    def add(self, table_name, user_name):
+        with self.lock:
+            if user_name not in self.registered.get(table_name, ()):
+                self.pending.setdefault(table_name, set()).add(user_name)
+
+    def submit(self, query):
+        logger.info(f"Query: {query[:200]} \nDatabase: {self.database}")
+        response = self.athena_client.start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={'Database': self.database},
+            ResultConfiguration={'OutputLocation': self.output_location}
+        )
+        return response['QueryExecutionId']
+
+    # Submits the pending chunks max_concurrency at a time, waiting on each window together,
+    # and returns {table_name: status}
+    def flush(self):
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        queries = [(table_name, query)
+                   for table_name, user_names in pending.items()
+                   for query in add_partition_queries(table_name, sorted(user_names))]
+
+        submitted = {}
+        executions = {}
+        for i in range(0, len(queries), self.max_concurrency):
+            window = {self.submit(query): table_name for table_name, query in queries[i:i + self.max_concurrency]}
+            executions.update(athena_poller.wait_for_queries(self.athena_client, list(window), timeout=self.timeout))
+            submitted.update(window)
+
+        status = {}
+        for query_execution_id, table_name in submitted.items():
+            state = athena_poller.state_of(executions.get(query_execution_id))
+            if state != 'SUCCEEDED':
+                logger.info(f"query_execution_id - {query_execution_id} ended up {state}")
+                status[table_name] = state
+            else:
+                status.setdefault(table_name, state)
+
+        with self.lock:
+            for table_name, user_names in pending.items():
+                if status.get(table_name) == 'SUCCEEDED':
+                    self.registered.setdefault(table_name, set()).update(user_names)
+                else:
+                    # Keep them for the next flush
+                    self.pending.setdefault(table_name, set()).update(user_names)
+            self.save()
+
+        return status
+
+    def save(self):
+        if self.state_path:
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({table: sorted(users) for table, users in self.registered.items()}, f, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+    # One-off switch of a table to partition projection, after which add() is not needed at all
+    def enable_projection(self, table_name, location_template):
+        query_execution_id = self.submit(projection_query(table_name, location_template))
+        execution = athena_poller.wait_for_query(self.athena_client, query_execution_id, timeout=self.timeout)
+        return athena_poller.state_of(execution)
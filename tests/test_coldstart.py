@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import bench_coldstart
+
+
+# A fresh interpreter per lambda, as on a new container: importing it and running the path that
+# needs no AWS (p2 query_flag 'N', p3 trigger_glue_job_flag 'N'; p1 is only imported) must not
+# load boto3, so a top-level boto3 import cannot come back unnoticed
+@pytest.mark.parametrize('name', ['p1', 'p2', 'p3'])
+def test_fast_path_does_not_import_boto3(name):
+    assert bench_coldstart.probe(name)['boto3_loaded'] is False
@@ -0,0 +1,41 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import bench_pipeline
+
+
+# Several p1 -> p2 -> p3 ticks against the bench fakes with p3 batching 4 slices per Glue run:
+# every slot p1 hands out moves its schedule on, and the queued slices are exported in batches
+def test_batched_slots_advance_and_export():
+
+    args = bench_pipeline.parse_args(['--glue-batch-size', '4', '--aws-latency', '0',
+                                      '--athena-duration', '0.002', '--glue-duration', '0.002'])
+    pipeline = bench_pipeline.Pipeline(args)
+
+    tick = datetime.datetime.combine(bench_pipeline.START_DATE, datetime.time(0, 1))
+    for _ in range(16):
+        tick += datetime.timedelta(minutes=15)
+        for file_type in bench_pipeline.FILE_TYPES:
+            pipeline.tick(file_type, tick)
+
+    assert pipeline.errors == 0
+    assert pipeline.slots >= 16
+
+    load_date = bench_pipeline.START_DATE.isoformat()
+    advanced = sum(pipeline.table.items[(file_type, load_date)]['next_slot'] - 1 for file_type in bench_pipeline.FILE_TYPES)
+    assert advanced == pipeline.slots
+
+    # Both file types share the Glue job, so a run starts whenever 4 of their slices are queued
+    assert len(pipeline.glue.runs) == pipeline.slots // 4
+
+    pipeline.p3.lambda_handler({'glue_flush': 'c2c_export'}, None)
+    queue = [item for (file_type, _), item in pipeline.table.items.items() if file_type == pipeline.p3.GLUE_QUEUE_FILE_TYPE]
+    assert len(queue) == pipeline.slots
+    assert all(item.get('exported_at') for item in queue)
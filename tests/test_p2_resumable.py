@@ -0,0 +1,86 @@
+import datetime
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import bench_pipeline
+
+ATHENA_DURATION = 0.1
+
+
+# p2 in resumable mode against the bench fakes, for a bills slot without a Glue export so that
+# p2 advances the slot itself once its queries are done
+@pytest.fixture
+def pipeline():
+    args = bench_pipeline.parse_args(['--aws-latency', '0', '--athena-duration', str(ATHENA_DURATION)])
+    pipeline = bench_pipeline.Pipeline(args)
+    pipeline.p2.EXECUTION_MODE = 'resumable'
+    pipeline.table.put_item(Item=dict(bench_pipeline.file_type_config('bills'), glue_export_flag=False))
+    return pipeline
+
+
+def next_slot(pipeline):
+    return pipeline.table.items[('bills', bench_pipeline.START_DATE.isoformat())]['next_slot']
+
+
+def athena_event(query_execution_id):
+    return {
+        'source': 'aws.athena',
+        'detail-type': 'Athena Query State Change',
+        'detail': {'queryExecutionId': query_execution_id, 'currentState': 'SUCCEEDED'}
+    }
+
+
+# The one query the continuation waits on, once it has finished on the fake
+def finished_query(continuation):
+    (query_execution_id,) = continuation['running'].values()
+    time.sleep(ATHENA_DURATION * 1.5)
+    return query_execution_id
+
+
+def test_submit_resume_and_finish(pipeline, monkeypatch):
+
+    tick = datetime.datetime.combine(bench_pipeline.START_DATE, datetime.time(0, 16))
+    p1_response = pipeline.schedule('bills', tick)
+    assert p1_response['body']['query_flag'] == 'Y'
+
+    # Submits the partition DDL and returns with the continuation
+    response = pipeline.p2.lambda_handler({'responsePayload': p1_response}, None)
+    assert response['statusCode'] == 202
+    assert list(response['body']['continuation']['running']) == ['bills:add_partition_00']
+    assert next_slot(pipeline) == 1
+
+    # Its completion event submits the insert that depended on it
+    response = pipeline.p2.lambda_handler(athena_event(finished_query(response['body']['continuation'])), None)
+    assert response['statusCode'] == 202
+    assert list(response['body']['continuation']['running']) == ['bills:insert_00']
+    assert next_slot(pipeline) == 1
+
+    # The insert's event is delivered twice, the duplicate arriving while the first delivery is
+    # between loading the continuation and claiming it: only one of them moves it on
+    query_execution_id = finished_query(response['body']['continuation'])
+    claim_continuation = pipeline.p2.claim_continuation
+    responses = []
+
+    def deliver_duplicate_first(continuation):
+        monkeypatch.setattr(pipeline.p2, 'claim_continuation', claim_continuation)
+        responses.append(pipeline.p2.lambda_handler(athena_event(query_execution_id), None))
+        return claim_continuation(continuation)
+
+    monkeypatch.setattr(pipeline.p2, 'claim_continuation', deliver_duplicate_first)
+    responses.append(pipeline.p2.lambda_handler(athena_event(query_execution_id), None))
+
+    assert [r['statusCode'] for r in responses] == [200, 409]
+    assert responses[0]['body']['STATUS'] == 'SUCCEEDED'
+    assert responses[1]['body']['STATUS'] == 'ALREADY_RESUMED'
+    assert next_slot(pipeline) == 2
+
+    # A redelivery after that finds no continuation left
+    assert pipeline.p2.lambda_handler(athena_event(query_execution_id), None)['statusCode'] == 204
+    assert not [key for key in pipeline.table.items if key[0] == pipeline.p2.CONTINUATION_FILE_TYPE]
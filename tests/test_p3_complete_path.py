@@ -0,0 +1,117 @@
+import datetime
+import json
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import bench_pipeline
+
+GLUE_DURATION = 0.1
+
+
+# p3 in event completion mode against the bench fakes: the start path hands the run over, and a
+# glue_poll or an aws.glue event completes it
+def start_glue_run(glue_failure_rate=0):
+
+    args = bench_pipeline.parse_args(['--aws-latency', '0', '--athena-duration', '0.002',
+                                      '--glue-duration', str(GLUE_DURATION), '--glue-failure-rate', str(glue_failure_rate)])
+    pipeline = bench_pipeline.Pipeline(args)
+    pipeline.p3.GLUE_COMPLETION_MODE = 'event'
+
+    tick = datetime.datetime.combine(bench_pipeline.START_DATE, datetime.time(0, 16))
+    p2_response = pipeline.p2.lambda_handler({'responsePayload': pipeline.schedule('bills', tick)}, None)
+    assert p2_response['body']['trigger_glue_job_flag'] == 'Y'
+
+    response = pipeline.p3.lambda_handler({'responsePayload': p2_response}, None)
+    assert response['statusCode'] == 202
+    body = json.loads(response['body'])
+    assert body['STATUS'] == 'STARTED'
+    return pipeline, p2_response, body['glue_poll']
+
+
+def next_slot(pipeline):
+    return pipeline.table.items[('bills', bench_pipeline.START_DATE.isoformat())]['next_slot']
+
+
+def pending_runs(pipeline):
+    return [key for key in pipeline.table.items if key[0] == pipeline.p3.GLUE_RUN_FILE_TYPE]
+
+
+def p3_lease(pipeline, p2_response):
+    # Imported by the lambdas once Pipeline has set config_table_name
+    import config_table
+    key = config_table.idempotency_key('p3', p2_response['body'])
+    return pipeline.table.items.get((config_table.IDEMPOTENCY_FILE_TYPE, key))
+
+
+def glue_event(glue_poll, state):
+    return {
+        'source': 'aws.glue',
+        'detail-type': 'Glue Job State Change',
+        'detail': {'jobName': glue_poll['glue_job_name'], 'jobRunId': glue_poll['job_run_id'], 'state': state,
+                   'message': 'Injected failure' if state == 'FAILED' else ''}
+    }
+
+
+def test_poll_completes_the_run():
+
+    pipeline, p2_response, glue_poll = start_glue_run()
+    assert next_slot(pipeline) == 1
+    assert p3_lease(pipeline, p2_response)['execution_status'] == 'IN_PROGRESS'
+
+    # Still running: the same poll payload comes back
+    response = pipeline.p3.lambda_handler({'glue_poll': glue_poll}, None)
+    assert response['statusCode'] == 202
+    assert response['glue_poll'] == glue_poll
+    assert next_slot(pipeline) == 1
+
+    time.sleep(GLUE_DURATION * 1.5)
+    response = pipeline.p3.lambda_handler({'glue_poll': glue_poll}, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['STATUS'] == 'SUCCEEDED'
+    assert next_slot(pipeline) == 2
+    assert p3_lease(pipeline, p2_response)['execution_status'] == 'COMPLETED'
+    assert not pending_runs(pipeline)
+
+    # The completion event arriving as well finds the run claimed already
+    assert pipeline.p3.lambda_handler(glue_event(glue_poll, 'SUCCEEDED'), None)['statusCode'] == 204
+    assert next_slot(pipeline) == 2
+
+
+def test_event_completes_the_run():
+
+    pipeline, p2_response, glue_poll = start_glue_run()
+
+    assert pipeline.p3.lambda_handler(glue_event(glue_poll, 'RUNNING'), None)['statusCode'] == 204
+
+    time.sleep(GLUE_DURATION * 1.5)
+    response = pipeline.p3.lambda_handler(glue_event(glue_poll, 'SUCCEEDED'), None)
+    assert response['statusCode'] == 200
+    assert next_slot(pipeline) == 2
+    assert p3_lease(pipeline, p2_response)['execution_status'] == 'COMPLETED'
+
+
+@pytest.mark.parametrize('complete_with', ['event', 'poll'])
+def test_failed_run_releases_the_lease(complete_with):
+
+    pipeline, p2_response, glue_poll = start_glue_run(glue_failure_rate=1)
+
+    time.sleep(GLUE_DURATION * 1.5)
+    event = glue_event(glue_poll, 'FAILED') if complete_with == 'event' else {'glue_poll': glue_poll}
+    with pytest.raises(Exception, match='Failed'):
+        pipeline.p3.lambda_handler(event, None)
+
+    # The slot stays queued and its lease is given back, so a retry starts a new run
+    assert next_slot(pipeline) == 1
+    assert p3_lease(pipeline, p2_response) is None
+    assert not pending_runs(pipeline)
+
+    response = pipeline.p3.lambda_handler({'responsePayload': p2_response}, None)
+    assert response['statusCode'] == 202
+    assert json.loads(response['body'])['glue_poll']['job_run_id'] != glue_poll['job_run_id']
@@ -0,0 +1,24 @@
+import os
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip('requests')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utility_api import TokenBucket
+
+
+# An API_RATE under 1 req/s used to leave the bucket below one token, so acquire() never returned
+@pytest.mark.parametrize('rate', [0.5, 0.1])
+def test_fractional_rate_acquires(rate):
+
+    bucket = TokenBucket(rate)
+    assert bucket.capacity == 1
+
+    taker = threading.Thread(target=bucket.acquire, daemon=True)
+    taker.start()
+    taker.join(timeout=1)
+    assert not taker.is_alive()
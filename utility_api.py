@@ -0,0 +1,143 @@
+import contextlib
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class UtilityApiError(Exception):
+    pass
+
+
+# Token bucket shared by every worker thread: `rate` requests per second with bursts up to `capacity`.
+# The bucket holds at least one token, or a rate under 1 req/s could never fill it far enough to take one.
+# pause() holds every taker back, which is how a Retry-After from one worker slows all of them down.
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# Retry-After is either a number of seconds or an HTTP date
+def retry_after_seconds(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+# UtilityAPI v2 client: one keep-alive pool, a shared rate limit, a cap on requests in flight,
+# connect/read timeouts and retries with backoff on throttling, 5xx and connection errors.
+# 404 is handed back to the caller as before; anything else still failing after the retries raises.
+class UtilityApiClient:
+
+    BASE_URL = 'https://utilityapi.com/api/v2'
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_token, rate=10, burst=None, max_concurrency=8, max_retries=5,
+                 backoff=0.5, max_backoff=30, connect_timeout=3.05, read_timeout=30):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f'Bearer {api_token}'})
+        self.counters = {'requests': 0, 'retries': 0, 'throttles': 0, 'server_errors': 0, 'connection_errors': 0}
+        self.counters_lock = threading.Lock()
+        self.set_concurrency(max_concurrency)
+
+    def set_concurrency(self, max_concurrency):
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.counters_lock:
+            return dict(self.counters)
+
+    def url(self, file_type):
+        return f'{self.BASE_URL}/{file_type}'
+
+    # A streamed response keeps its connection until the body has been read, so its slot has to be
+    # held that long too: the caller takes it with acquire_slot, passes slot_held=True to get() and
+    # gives it back with release_slot once the response is closed
+    def acquire_slot(self, blocking=True):
+        return self.slots.acquire(blocking)
+
+    def release_slot(self):
+        self.slots.release()
+
+    def get(self, url, params=None, stream=False, slot_held=False):
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self.count('requests')
+            try:
+                with contextlib.nullcontext() if slot_held else self.slots:
+                    response = self.session.get(url, params=params, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.count('connection_errors')
+                if attempt == self.max_retries:
+                    raise UtilityApiError(f"GET {url} failed after {attempt + 1} attempts: {e}") from e
+                self.retry_sleep(attempt)
+                continue
+
+            if response.status_code not in self.RETRY_STATUSES:
+                return response
+
+            self.count('throttles' if response.status_code == 429 else 'server_errors')
+            if attempt == self.max_retries:
+                raise UtilityApiError(f"GET {url} still returned {response.status_code} after {attempt + 1} attempts")
+
+            retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+            response.close()
+            if retry_after is not None:
+                # Everyone backs off, not just this worker
+                logger.info(f"Throttled on {url}, pausing for {retry_after:.1f}s")
+                self.bucket.pause(retry_after)
+                self.count('retries')
+            else:
+                self.retry_sleep(attempt)
+
+    def retry_sleep(self, attempt):
+        self.count('retries')
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))